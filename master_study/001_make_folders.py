@@ -10,10 +10,16 @@ import yaml
 import shutil
 import copy
 import json
+from filling_scheme_store import load_filling_scheme
 from user_defined_functions import (
     generate_run_sh,
     generate_run_sh_htc,
-    get_worst_bunch,
+    get_scan_overrides,
+    iter_scan_grid,
+    load_refined_points,
+    make_folders_parallel,
+    write_children_configurations,
+    select_bunches,
     reformat_filling_scheme_from_lpc_alt,
 )
 
@@ -39,6 +45,13 @@ d_config_particles["n_angles"] = 5
 # Number of split for parallelization
 d_config_particles["n_split"] = 4
 
+# Adaptive search of the DA boundary (None to track the full polar grid). If used, the grid defined
+# above is only the initial (coarse) one: it is refined around the first lost amplitude of each
+# angle during n_rounds tracking rounds, with n_r_per_round new amplitudes per round. Chunks are then
+# split by angle, so n_split can't be larger than n_angles.
+adaptive_da = None  # e.g. {"n_rounds": 3, "n_r_per_round": 8}, with a coarser n_r
+d_config_particles["split_by_angle"] = adaptive_da is not None
+
 # ==================================================================================================
 # --- Optics collider parameters (generation 1)
 #
@@ -65,6 +78,11 @@ beam_energy_tot = 7000
 d_config_mad["beam_config"]["lhcb1"]["beam_energy_tot"] = beam_energy_tot
 d_config_mad["beam_config"]["lhcb2"]["beam_energy_tot"] = beam_energy_tot
 
+# Format of the base collider file ("json" or "binary"). The binary format is compressed and
+# memory-mapped, which makes it much faster to load for the numerous jobs of generation 2.
+d_config_mad["collider_format"] = "json"  # e.g. "binary"
+collider_extension = "bin" if d_config_mad["collider_format"] == "binary" else "json"
+
 
 # ==================================================================================================
 # --- Base collider parameters (generation 2)
@@ -149,6 +167,20 @@ d_config_beambeam["num_particles_per_bunch"] = 1.4e11
 d_config_beambeam["nemitt_x"] = 2.5e-6
 d_config_beambeam["nemitt_y"] = 2.5e-6
 
+# Beam-beam lenses. If install_beam_beam_in_base_collider is True, the lenses are installed once in
+# the base collider (generation 1) instead of in every job of generation 2. These parameters can't be
+# scanned in that case.
+install_beam_beam_in_base_collider = False
+d_config_beambeam["num_long_range_encounters_per_side"] = {
+    "ip1": 25,
+    "ip2": 20,
+    "ip5": 25,
+    "ip8": 20,
+}
+d_config_beambeam["num_slices_head_on"] = 11
+d_config_beambeam["bunch_spacing_buckets"] = 10
+d_config_beambeam["sigma_z"] = 0.0761
+
 # Filling scheme (in json format)
 # The scheme should consist of a json file containing two lists of booleans (one for each beam),
 # representing each bucket of the LHC.
@@ -163,15 +195,16 @@ filling_scheme_path = os.path.abspath(
 # https://lpc.web.cern.ch/cgi-bin/schemeInfo.py?fill=XXXX&fmt=json
 # Unfortunately, the format is not the same as the one used by defaults in xmask, but it should
 # still be converted in the lines below (see with matteo.rufolo@cern.ch for questions, or if it
-# doesn't work).
+# doesn't work). All the fills of a LPC file, or all the LPC files of a folder, can also be converted
+# at once with convert_filling_scheme_from_lpc and convert_filling_schemes_from_lpc_in_folder (in
+# user_defined_functions.py).
 
-# Load filling scheme
-if filling_scheme_path.endswith(".json"):
-    with open(filling_scheme_path, "r") as fid:
-        d_filling_scheme = json.load(fid)
+# Load filling scheme (it's indexed in the filling scheme store the first time it's loaded, such
+# that it's not parsed again by the other scripts)
+d_filling_scheme = load_filling_scheme(filling_scheme_path)
 
 # If the filling scheme is already in the correct format, do nothing
-if "beam1" in d_filling_scheme.keys() and "beam2" in d_filling_scheme.keys():
+if d_filling_scheme is not None:
     pass
 # Otherwise, we need to reformat the file
 else:
@@ -185,47 +218,33 @@ d_config_beambeam["mask_with_filling_pattern"][
     "pattern_fname"
 ] = filling_scheme_path  # If None, a full fill is assumed
 
-# Set this variable to False if you intend to scan the bunch number (but ensure both bunches indices
-# are defined later)
-d_config_beambeam["mask_with_filling_pattern"]["i_bunch_b1"] = None
-d_config_beambeam["mask_with_filling_pattern"]["i_bunch_b2"] = None
-check_bunch_number = True
-if check_bunch_number:
-    # Bunch number (ignored if pattern_fname is None (in which case the simulation considers all bunch
-    # elements), must be specified otherwise)
-    # If the bunch number is None and pattern_name is defined, the bunch with the largest number of
-    # long-range interactions will be used
-    if d_config_beambeam["mask_with_filling_pattern"]["i_bunch_b1"] is None:
-        # Case the bunch number has not been provided
-        worst_bunch_b1 = get_worst_bunch(
-            filling_scheme_path, numberOfLRToConsider=26, beam="beam_1"
-        )
-        while d_config_beambeam["mask_with_filling_pattern"]["i_bunch_b1"] is None:
-            bool_inp = input(
-                "The bunch number for beam 1 has not been provided. Do you want to use the bunch"
-                " with the largest number of long-range interactions? It is the bunch number "
-                + str(worst_bunch_b1)
-                + " (y/n): "
-            )
-            if bool_inp == "y":
-                d_config_beambeam["mask_with_filling_pattern"]["i_bunch_b1"] = worst_bunch_b1
-            elif bool_inp == "n":
-                d_config_beambeam["mask_with_filling_pattern"]["i_bunch_b1"] = int(
-                    input("Please enter the bunch number for beam 1: ")
-                )
-
-    if d_config_beambeam["mask_with_filling_pattern"]["i_bunch_b2"] is None:
-        worst_bunch_b2 = get_worst_bunch(
-            filling_scheme_path, numberOfLRToConsider=26, beam="beam_2"
-        )
-        # For beam 2, just select the worst bunch by default, as the tracking of b2 is not available yet anyway
-        print(
-            "The bunch number for beam 2 has not been provided. By default, the worst bunch is"
-            " taken. It is the bunch number "
-            + str(worst_bunch_b2)
-        )
+# Bunch selection policy for each beam (ignored if pattern_fname is None, in which case the
+# simulation considers all bunch elements):
+# - "worst": the bunch with the largest number of long-range interactions
+# - "explicit": the bunch number provided below
+# - "top_k": the k bunches with the largest number of long-range interactions, scanned as an extra
+#   dimension of the tree if the beam is tracked (paired with the bunches of the other beam if both
+#   beams are tracked, see the scan dimensions below)
+# - "all_unique_schedules": all the bunches of the beam, tracked once per distinct collision schedule
+#   as a cheap dimension of the generation 2 jobs (the worst bunch is used to configure the collider)
+# The bunches are ranked ahead of time, in the filling scheme store
+d_bunch_selection = {
+    "i_bunch_b1": {"policy": "worst", "i_bunch": None, "k": 4},
+    "i_bunch_b2": {"policy": "worst", "i_bunch": None, "k": 4},
+}
+d_l_bunches = {}
+d_cheap_bunch_dimensions = {}
+for name, beam in [("i_bunch_b1", "beam_1"), ("i_bunch_b2", "beam_2")]:
+    d_l_bunches[name] = select_bunches(
+        filling_scheme_path, **d_bunch_selection[name], numberOfLRToConsider=26, beam=beam
+    )
+    print(f"Selected bunch(es) for {beam}: {d_l_bunches[name]}")
+    if d_bunch_selection[name]["policy"] == "all_unique_schedules":
+        d_cheap_bunch_dimensions[name] = "all_unique_schedules"
 
-        d_config_beambeam["mask_with_filling_pattern"]["i_bunch_b2"] = worst_bunch_b2
+# Bunch numbers (mutated in the scan below if several bunches are selected)
+d_config_beambeam["mask_with_filling_pattern"]["i_bunch_b1"] = d_l_bunches["i_bunch_b1"][0]
+d_config_beambeam["mask_with_filling_pattern"]["i_bunch_b2"] = d_l_bunches["i_bunch_b2"][0]
 
 
 # ==================================================================================================
@@ -256,12 +275,37 @@ d_config_simulation = {}
 # Number of turns to track
 d_config_simulation["n_turns"] = 200
 
+# Number of turns between two checkpoints (None to disable checkpointing). If a job is interrupted
+# (e.g. evicted from HTCondor), it will resume from the last checkpoint when restarted. Not available
+# with the adaptive DA search or the cheap dimensions below, which track several times.
+d_config_simulation["n_turns_per_checkpoint"] = None
+d_config_simulation["checkpoint_folder"] = "checkpoint"
+
 # Initial off-momentum
 d_config_simulation["delta_max"] = 27.0e-5
 
-# Beam to track (lhcb1 or lhcb2)
+# Beam to track (lhcb1, lhcb2, or both, tracked concurrently in the same job)
 d_config_simulation["beam"] = "lhcb1"
 
+# Number of processes used to track the particles of a job (the same number of cpus is requested
+# when submitting on HTCondor). With several workers, consider decreasing n_split accordingly.
+d_config_simulation["n_workers"] = 1
+
+# Adaptive search of the DA boundary (defined with the particle distribution parameters)
+d_config_simulation["adaptive_da"] = adaptive_da
+
+# Dimensions scanned within each job, since they don't require to rematch the collider (e.g.
+# octupoles, tracked bunch, delta_max). All the combinations of the values are tracked by each job,
+# and stored as columns of the output. None to disable.
+d_config_simulation["cheap_dimensions"] = None  # e.g. {"i_oct_b1": [-300, 0, 300]}
+
+# Add the bunches selected with the all_unique_schedules policy to the cheap dimensions
+if len(d_cheap_bunch_dimensions) > 0:
+    d_config_simulation["cheap_dimensions"] = {
+        **(d_config_simulation["cheap_dimensions"] or {}),
+        **d_cheap_bunch_dimensions,
+    }
+
 # ==================================================================================================
 # --- Dump collider and collider configuration
 #
@@ -271,20 +315,105 @@ d_config_simulation["beam"] = "lhcb1"
 dump_collider = False
 dump_config_in_collider = False
 
+# ==================================================================================================
+# --- Share configured colliders
+#
+# Below, the user chooses if the configured collider must be shared between the jobs having the same
+# collider configuration (i.e. the n_split particle chunks of a given working point), such that only
+# the first job pays for the configuration. Path is relative to the generation 2 jobs. Set to None to
+# configure the collider in each job. Note that one collider is stored per working point, and that
+# the entries are never removed: don't use it on afs, and delete the folder once the study is done.
+# ==================================================================================================
+configured_collider_cache = None  # e.g. "../configured_colliders"
+
+# The base colliders (generation 1) can also be shared between studies having the same optics
+# configuration. Path is relative to the generation 1 job (here, master_study/base_colliders). Set to
+# None to always rebuild the base collider from mad. Only the files of the optics folder are tracked:
+# delete the cache if the optics file calls files from other folders that have changed.
+base_collider_cache = None  # e.g. "../../../base_colliders"
+
+# Similarly, the compiled tracking kernels can be shared between all the jobs of the study (or set
+# an absolute path to a node-local folder). Set to None to compile the kernels in each job. The
+# kernels prebuilt by xsuite-prebuild are used in priority, and the cache is only used with the
+# xtrack versions listed in study_cache.py.
+kernel_cache = None  # e.g. "../compiled_kernels"
+
+# The knobs obtained by matching (tune, chromaticity, leveling) are stored at the study level, such
+# that the matchings of a working point start from the solution of the nearest working point already
+# configured. Set to None to always start from the knobs of the base collider.
+knob_store = None  # e.g. "../knob_store"
+
+# The response of the tune and chromaticity to the tuning knobs can be computed once in generation 1,
+# such that the matchings of generation 2 start with a few iterations on this response. Set to False
+# to always do the full matching.
+use_tune_chroma_response = False
+
 # ==================================================================================================
 # --- Machine parameters being scanned (generation 2)
 #
-# Below, the user defines the grid for the machine parameters that must be scanned to find the
-# optimal DA (e.g. tune, chroma, etc).
+# The grid for the machine parameters that must be scanned to find the optimal DA (e.g. tune,
+# chroma, etc), along with the constraints on the working points, is defined in the scan section of
+# config.yaml. The particle chunks and the selected bunches are added below as extra dimensions.
 # ==================================================================================================
-# Scan tune with step of 0.001 (need to round to correct for numpy numerical instabilities)
-array_qx = np.round(np.arange(62.305, 62.330, 0.001), decimals=4)[:5]
-array_qy = np.round(np.arange(60.305, 60.330, 0.001), decimals=4)[:5]
-
-# In case one is doing a tune-tune scan, to decrease the size of the scan, we can ignore the
-# working points too close to resonance. Otherwise just delete this variable in the loop at the end
-# of the script
-keep = "upper_triangle"  # 'lower_triangle', 'all'
+# Define study name
+study_name = "example_HL_tunescan"
+
+d_scan = yaml.safe_load(open("config.yaml"))["scan"]
+d_scan_dimensions = {
+    "track": {
+        "paths": ["config_simulation.particle_file"],
+        "values": list(range(d_config_particles["n_split"])),
+        "format": "../particles/{:02}.parquet",
+    },
+    **d_scan["dimensions"],
+}
+
+# Only the bunches of the tracked beam(s) are scanned, the other beam keeping its first selected
+# bunch (e.g. the worst one). When both beams are tracked, the bunches selected for the two beams
+# are paired (e.g. the i-th worst bunch of each beam with top_k) rather than combined
+l_tracked_bunches = {
+    "lhcb1": ["i_bunch_b1"],
+    "lhcb2": ["i_bunch_b2"],
+    "both": ["i_bunch_b1", "i_bunch_b2"],
+}[d_config_simulation["beam"]]
+for name in l_tracked_bunches:
+    d_scan_dimensions[name] = {
+        "paths": [f"config_collider.config_beambeam.mask_with_filling_pattern.{name}"],
+        "values": d_l_bunches[name],
+    }
+    if all(len(d_l_bunches[name_tracked]) > 1 for name_tracked in l_tracked_bunches):
+        d_scan_dimensions[name]["zip"] = "bunches"
+
+# The grid and the constraints are evaluated by batches of working points while building the tree,
+# such that the whole scan is never in memory at once
+iter_scan_batches = iter_scan_grid(d_scan_dimensions, d_scan.get("constraints", None) or [])
+
+# The folders of the tree are written one after the other by tree_maker, or concurrently if
+# parallel_make_folders is True (threads are used since this is limited by the filesystem latency),
+# which is much faster for large scans. In the latter case, the configurations of the children are
+# also written while iterating over the grid, and the tree only holds their names, such that scans
+# of millions of working points fit in memory. Otherwise, tree_maker needs all the children in the
+# tree.
+parallel_make_folders = False
+n_threads_make_folders = 32
+
+# Append the working points added by the coarse-to-fine refinement of the scan (see
+# 004_refine_scan.py), if any. They come after the points of the initial grid, such that the existing
+# jobs keep their names, and only the new jobs are written to the filesystem (and then submitted).
+# This requires parallel_make_folders, as tree_maker would rewrite the existing jobs
+l_refined_points = load_refined_points(study_name)
+if len(l_refined_points) > 0:
+    if not parallel_make_folders:
+        raise ValueError(
+            "Refined working points can only be appended to an existing tree with"
+            " parallel_make_folders = True, since tree_maker rewrites the existing jobs."
+        )
+    d_refined_dimensions = copy.deepcopy(d_scan_dimensions)
+    for name in l_refined_points[0]:
+        d_refined_dimensions[name]["values"] = [point[name] for point in l_refined_points]
+        d_refined_dimensions[name]["zip"] = "refined_points"
+    iter_scan_batches = itertools.chain(iter_scan_batches, iter_scan_grid(d_refined_dimensions))
+
 # ==================================================================================================
 # --- Make tree for the simulations (generation 1)
 #
@@ -302,6 +431,26 @@ children["base_collider"]["config_particles"] = d_config_particles
 # Add base machine parameters to the first generation
 children["base_collider"]["config_mad"] = d_config_mad
 
+# Add the base colliders cache to the first generation
+children["base_collider"]["base_collider_cache"] = base_collider_cache
+
+# Only compute the response of the tune and chromaticity if generation 2 uses it (the knobs are
+# defined in the configuration of generation 1)
+if not use_tune_chroma_response:
+    children["base_collider"]["tune_chroma_response"] = None
+
+# Install the beam-beam lenses in the first generation if requested
+if install_beam_beam_in_base_collider:
+    children["base_collider"]["config_beambeam_install"] = {
+        key: d_config_beambeam[key]
+        for key in [
+            "num_long_range_encounters_per_side",
+            "num_slices_head_on",
+            "bunch_spacing_buckets",
+            "sigma_z",
+        ]
+    }
+
 
 # ==================================================================================================
 # --- Complete tree for the simulations (generation 2)
@@ -309,38 +458,40 @@ children["base_collider"]["config_mad"] = d_config_mad
 # We now set a second generation for the tree. This second generation contains the tracking
 # parameters, as well as a default set of parameters for the colliders (defined above), that we
 # mutate according to the parameters we want to scan.
-# ! Caution when mutating the dictionnary in this function, you have to pass a deepcopy to children,
-# ! otherwise the dictionnary will be mutated for all the children.
+# The default parameters are stored only once, in the first generation, and each child only
+# contains the parameters that it overrides (e.g. the scanned ones). The full configuration of a
+# child is materialized by the job itself, when reading its configuration.
+# ! Caution: the overrides of a child must only contain the parameters being mutated, as they
+# ! replace the default values (nested dictionnaries are merged).
 # ==================================================================================================
-track_array = np.arange(d_config_particles["n_split"])
-for idx_job, (track, qx, qy) in enumerate(itertools.product(track_array, array_qx, array_qy)):
-    # If requested, ignore conditions below the upper diagonal as they can't be reached in the LHC
-    if keep == "upper_triangle":
-        if qy < (qx - 2 - 0.0039):  # 0.039 instead of 0.04 to avoid rounding errors
-            continue
-    elif keep == "lower_triangle":
-        if qy >= (qx - 2 - 0.0039):
-            continue
-    else:
-        pass
-
-    # Mutate the appropriate collider parameters
-    for beam in ["lhcb1", "lhcb2"]:
-        d_config_collider["config_knobs_and_tuning"]["qx"][beam] = float(qx)
-        d_config_collider["config_knobs_and_tuning"]["qy"][beam] = float(qy)
-
-    # Complete the dictionnary for the tracking
-    d_config_simulation["particle_file"] = f"../particles/{track:02}.parquet"
-    d_config_simulation["collider_file"] = f"../collider/collider.json"
-
-    # Add a child to the second generation, with all the parameters for the collider and tracking
-    children["base_collider"]["children"][f"xtrack_{idx_job:04}"] = {
-        "config_simulation": copy.deepcopy(d_config_simulation),
-        "config_collider": copy.deepcopy(d_config_collider),
-        "log_file": "tree_maker.log",
-        "dump_collider": dump_collider,
-        "dump_config_in_collider": dump_config_in_collider,
-    }
+# Complete the dictionnary for the tracking with the parameters shared by all the children
+d_config_simulation["collider_file"] = f"../collider/collider.{collider_extension}"
+d_config_simulation["tune_chroma_response_file"] = (
+    "../collider/tune_chroma_response.json" if use_tune_chroma_response else None
+)
+d_config_simulation["configured_collider_cache"] = configured_collider_cache
+d_config_simulation["kernel_cache"] = kernel_cache
+d_config_simulation["knob_store"] = knob_store
+
+# Add the default configuration of the children to the first generation
+children["base_collider"]["config_children"] = {
+    "config_simulation": d_config_simulation,
+    "config_collider": d_config_collider,
+    "dump_collider": dump_collider,
+    "dump_config_in_collider": dump_config_in_collider,
+}
+
+# Add the children to the second generation, with only the parameters overriding the default ones
+# (unless they're written while iterating over the grid, see parallel_make_folders above)
+if not parallel_make_folders:
+    idx_job = 0
+    for d_scan_batch in iter_scan_batches:
+        for idx_point in range(len(d_scan_batch["track"])):
+            children["base_collider"]["children"][f"xtrack_{idx_job:04}"] = {
+                "config_overrides": get_scan_overrides(d_scan_dimensions, d_scan_batch, idx_point),
+                "log_file": "tree_maker.log",
+            }
+            idx_job += 1
 
 # ==================================================================================================
 # --- Simulation configuration
@@ -351,15 +502,18 @@ config = yaml.safe_load(open("config.yaml"))
 # # Set the root children to the ones defined above
 config["root"]["children"] = children
 
+# The scan has already been used to build the children
+config.pop("scan", None)
+
+# Request as many cpus as tracking workers for generation 2
+config["root"]["generations"][2]["request_cpus"] = d_config_simulation["n_workers"]
+
 # Set miniconda environment path in the config
 config["root"]["setup_env_script"] = os.getcwd() + "/../activate_miniforge.sh"
 
 # ==================================================================================================
 # --- Build tree and write it to the filesystem
 # ==================================================================================================
-# Define study name
-study_name = "example_HL_tunescan"
-
 # Creade folder that will contain the tree
 if not os.path.exists("scans/" + study_name):
     os.makedirs("scans/" + study_name)
@@ -367,11 +521,30 @@ if not os.path.exists("scans/" + study_name):
 # Move to the folder that will contain the tree
 os.chdir("scans/" + study_name)
 
-# Clean the id_job file
+# Clean the id_job file (unless jobs are being appended to the study, since some jobs may still be
+# running)
 id_job_file_path = "id_job.yaml"
-if os.path.isfile(id_job_file_path):
+if os.path.isfile(id_job_file_path) and len(l_refined_points) == 0:
     os.remove(id_job_file_path)
 
+# Write the configurations of the children while iterating over the grid, and only add their names
+# (and log file) to the tree (see parallel_make_folders above). When appending refined working
+# points, the existing children are left untouched
+if parallel_make_folders:
+    start_time = time.time()
+    l_children_names = write_children_configurations(
+        "base_collider",
+        config["root"]["generations"][2]["job_folder"],
+        d_scan_dimensions,
+        iter_scan_batches,
+        n_threads=n_threads_make_folders,
+        skip_existing=len(l_refined_points) > 0,
+    )
+    for name in l_children_names:
+        children["base_collider"]["children"][name] = {"log_file": "tree_maker.log"}
+    print("The configurations of the children are written.")
+    print("--- %s seconds ---" % (time.time() - start_time))
+
 # Create tree object
 start_time = time.time()
 root = initialize(config)
@@ -384,8 +557,17 @@ if "htc" in config["root"]["generations"][2]["run_on"]:
 else:
     generate_run = generate_run_sh
 
-# From python objects we move the nodes to the filesystem.
+# From python objects we move the nodes to the filesystem (see parallel_make_folders above). When
+# appending refined working points, the existing folders are left untouched
 start_time = time.time()
-root.make_folders(generate_run)
+if parallel_make_folders:
+    make_folders_parallel(
+        root,
+        generate_run,
+        n_threads=n_threads_make_folders,
+        skip_existing=len(l_refined_points) > 0,
+    )
+else:
+    root.make_folders(generate_run)
 print("The tree folders are ready.")
 print("--- %s seconds ---" % (time.time() - start_time))
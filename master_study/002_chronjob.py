@@ -233,6 +233,10 @@ class ClusterSubmission:
         # Write the submission file
         with open(filename, "w") as fid:
             fid.write(str_head)
+
+            # Request several cpus if needed (e.g. for multi-process tracking)
+            if self.run_on in ["htc", "htc_docker"] and "request_cpus" in self.config:
+                fid.write(f"request_cpus = {self.config['request_cpus']}\n")
             for node in list_of_nodes:
                 # Get path node
                 path_node = node.get_abs_path()
@@ -541,8 +545,11 @@ def submit_jobs(study_name, print_uncompleted_jobs=False):
     root = tree_maker.tree_from_json(fix[1:] + "/tree_maker.json")
     root.add_suffix(suffix=fix)
 
-    # Check that the study is not done yet
-    if root.has_been("completed"):
+    # Check that the study is not done yet (jobs may have been appended to a completed study when
+    # refining the scan)
+    if root.has_been("completed") and all(
+        [descendant.has_been("completed") for descendant in root.descendants]
+    ):
         print("All descendants of root are completed!")
     else:
         # Check generation 1
@@ -6,6 +6,7 @@ import yaml
 import pandas as pd
 import time
 import logging
+from user_defined_functions import materialize_child_configuration
 
 # ==================================================================================================
 # --- Load tree of jobs
@@ -28,12 +29,18 @@ root.add_suffix(suffix=fix)
 # ==================================================================================================
 l_problematic_sim = []
 l_df_to_merge = []
+l_cheap_dimensions = []
 for node in root.generation(1):
     with open(f"{node.get_abs_path()}/config.yaml", "r") as fid:
         config_parent = yaml.safe_load(fid)
     for node_child in node.children:
         with open(f"{node_child.get_abs_path()}/config.yaml", "r") as fid:
-            config_child = yaml.safe_load(fid)
+            config_child = materialize_child_configuration(yaml.safe_load(fid), config_parent)
+
+        # Register the dimensions scanned within the job (cheap dimensions), to group by them
+        for name in config_child["config_simulation"].get("cheap_dimensions", None) or {}:
+            if name not in l_cheap_dimensions:
+                l_cheap_dimensions.append(name)
 
         try:
             # Read the particle path as relative
@@ -59,44 +66,60 @@ for node in root.generation(1):
         df_sim["path simulation"] = f"{node_child.get_abs_path()}"
         df_sim["name simulation"] = f"{node_child.name}"
 
-        # Get node parameters as dictionnaries for parameter assignation
-        dic_child_collider = node_child.parameters["config_collider"]
-        dic_child_simulation = node_child.parameters["config_simulation"]
+        # Get node parameters as dictionnaries for parameter assignation (the parameters of the
+        # child are overrides of the default configuration stored in the parent). If the tree only
+        # holds the log file of the child (see write_children_configurations), the configuration of
+        # the child is used instead
+        if "config_overrides" in node_child.parameters:
+            parameters_child = materialize_child_configuration(
+                node_child.parameters, node.parameters
+            )
+        else:
+            parameters_child = config_child
+        dic_child_collider = parameters_child["config_collider"]
+        dic_child_simulation = parameters_child["config_simulation"]
         try:
             dic_parent_collider = node.parameters["config_mad"]
         except:
             print("No parent collider could be loaded")
         dic_parent_particles = node.parameters["config_particles"]
 
-        # Get which beam is being tracked
-        df_sim["beam"] = dic_child_simulation["beam"]
-
-        # Get scanned parameters (complete with the requested scanned parameters)
-        df_sim["qx"] = dic_child_collider["config_knobs_and_tuning"]["qx"]["lhcb1"]
-        df_sim["qy"] = dic_child_collider["config_knobs_and_tuning"]["qy"]["lhcb1"]
-        df_sim["dqx"] = dic_child_collider["config_knobs_and_tuning"]["dqx"]["lhcb1"]
-        df_sim["dqy"] = dic_child_collider["config_knobs_and_tuning"]["dqy"]["lhcb1"]
-        df_sim["i_bunch_b1"] = dic_child_collider["config_beambeam"]["mask_with_filling_pattern"][
-            "i_bunch_b1"
-        ]
-        df_sim["i_bunch_b2"] = dic_child_collider["config_beambeam"]["mask_with_filling_pattern"][
-            "i_bunch_b2"
-        ]
-        df_sim["num_particles_per_bunch"] = dic_child_collider["config_beambeam"][
-            "num_particles_per_bunch"
-        ]
-        df_sim["i_oct_b1"] = dic_child_collider["config_knobs_and_tuning"]["knob_settings"][
-            "i_oct_b1"
-        ]
-        df_sim["i_oct_b2"] = dic_child_collider["config_knobs_and_tuning"]["knob_settings"][
-            "i_oct_b2"
-        ]
-        df_sim["crossing_angle"] = abs(
-            float(dic_child_collider["config_knobs_and_tuning"]["knob_settings"]["on_x1"])
-        )
-
-        # Merge with particle data
-        df_sim_with_particle = pd.merge(df_sim, particle, on=["particle_id"])
+        # Get which beam is being tracked (already in the output if both beams have been tracked)
+        if "beam" not in df_sim.columns:
+            df_sim["beam"] = dic_child_simulation["beam"]
+
+        # Get scanned parameters (complete with the requested scanned parameters). Parameters
+        # scanned within the job (cheap dimensions) are already in the output
+        d_parameters = {
+            "qx": dic_child_collider["config_knobs_and_tuning"]["qx"]["lhcb1"],
+            "qy": dic_child_collider["config_knobs_and_tuning"]["qy"]["lhcb1"],
+            "dqx": dic_child_collider["config_knobs_and_tuning"]["dqx"]["lhcb1"],
+            "dqy": dic_child_collider["config_knobs_and_tuning"]["dqy"]["lhcb1"],
+            "i_bunch_b1": dic_child_collider["config_beambeam"]["mask_with_filling_pattern"][
+                "i_bunch_b1"
+            ],
+            "i_bunch_b2": dic_child_collider["config_beambeam"]["mask_with_filling_pattern"][
+                "i_bunch_b2"
+            ],
+            "num_particles_per_bunch": dic_child_collider["config_beambeam"][
+                "num_particles_per_bunch"
+            ],
+            "i_oct_b1": dic_child_collider["config_knobs_and_tuning"]["knob_settings"]["i_oct_b1"],
+            "i_oct_b2": dic_child_collider["config_knobs_and_tuning"]["knob_settings"]["i_oct_b2"],
+            "crossing_angle": abs(
+                float(dic_child_collider["config_knobs_and_tuning"]["knob_settings"]["on_x1"])
+            ),
+        }
+        for parameter, value in d_parameters.items():
+            if parameter not in df_sim.columns:
+                df_sim[parameter] = value
+
+        # Merge with particle data (unless already present in the output, e.g. if the DA boundary
+        # has been searched adaptively)
+        if "normalized amplitude in xy-plane" in df_sim.columns:
+            df_sim_with_particle = df_sim
+        else:
+            df_sim_with_particle = pd.merge(df_sim, particle, on=["particle_id"])
         l_df_to_merge.append(df_sim_with_particle)
 
 # ==================================================================================================
@@ -113,10 +136,12 @@ df_lost_particles = df_all_sim[df_all_sim["state"] != 1]  # Lost particles
 if df_lost_particles.empty:
     print("No unstable particles found, the output dataframe will be empty.")
 
-# Group by working point (Update this with the knobs you want to group by !)
+# Group by working point (Update this with the knobs you want to group by, the cheap dimensions are
+# added automatically)
 group_by_parameters = ["qx", "qy"]
 # We always want to keep beam in the final result
 group_by_parameters = ["beam"] + group_by_parameters
+group_by_parameters += [name for name in l_cheap_dimensions if name not in group_by_parameters]
 l_parameters_to_keep = [
     "normalized amplitude in xy-plane",
     "qx",
@@ -128,6 +153,7 @@ l_parameters_to_keep = [
     "num_particles_per_bunch",
     "crossing_angle",
 ]
+l_parameters_to_keep += [name for name in l_cheap_dimensions if name not in l_parameters_to_keep]
 
 # Min is computed in the groupby function, but values should be identical
 my_final = pd.DataFrame(
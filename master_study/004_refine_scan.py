@@ -0,0 +1,188 @@
+"""This script is used to refine the working-point scan of a study, from coarse to fine. Starting from
+the DA computed by 003_postprocessing.py, new working points are added at the middle of the pairs of
+neighbouring working points whose DA differ by more than a threshold, or which are close to a
+resonance line. The new points are stored in scans/<study_name>/refined_points.yaml, and appended
+to the tree of jobs when running 001_make_folders.py again, such that 002_chronjob.py only submits
+the new jobs. This can be repeated (003 -> 004 -> 001 -> 002), until the budget of working points is
+reached or the DA map doesn't need to be refined anymore. The script must be run once all the jobs
+of the previous stage are completed and postprocessed."""
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+import glob
+import numpy as np
+import pandas as pd
+import yaml
+from user_defined_functions import (
+    build_scan_grid,
+    evaluate_scan_constraints,
+    load_refined_points,
+    store_refined_points,
+)
+
+# ==================================================================================================
+# --- Parameters of the refinement
+# ==================================================================================================
+# Define study name
+study_name = "example_HL_tunescan"
+
+# Dimensions of the scan (as defined in the scan section of config.yaml) to refine. They must be
+# kept in da.parquet by 003_postprocessing.py
+l_refined_dimensions = ["qx", "qy"]
+
+# Neighbouring working points are refined if their DA differ by more than this threshold [sigma]
+da_threshold = 0.5
+
+# Neighbouring working points are also refined if one of them is closer than resonance_distance to a
+# resonance line of order up to resonance_order. This assumes that the refined dimensions are the
+# horizontal and vertical tunes (set resonance_order to 0 otherwise)
+resonance_order = 3
+resonance_distance = 0.0015
+
+# Neighbouring working points closer than min_step are not refined anymore
+min_step = 0.0005
+
+# Number of decimals of the new working points
+decimals = 5
+
+# Budget: maximal number of working points added per stage, and maximal total number of working
+# points in the scan (initial grid included)
+max_points_per_stage = 50
+max_points_total = 300
+
+
+# ==================================================================================================
+# --- Functions to refine the scan
+# ==================================================================================================
+def get_existing_points(d_scan):
+    # Working points of the initial grid of the scan and of the previous refinement stages
+    d_grid = build_scan_grid(d_scan["dimensions"], d_scan.get("constraints", None) or [])
+    df_points = pd.concat(
+        [
+            pd.DataFrame({name: d_grid[name] for name in l_refined_dimensions}),
+            pd.DataFrame(load_refined_points(study_name), columns=l_refined_dimensions),
+        ]
+    )
+    return df_points.astype(float).round(decimals).drop_duplicates().reset_index(drop=True)
+
+
+def get_max_tracked_amplitude():
+    # Largest amplitude of the tracked particles, from the configuration of the particles distribution
+    # of the base colliders (generation 1) of the study
+    l_r_max = []
+    for path in glob.glob(f"scans/{study_name}/*/config.yaml"):
+        with open(path, "r") as fid:
+            config = yaml.safe_load(fid)
+        if "config_particles" in config:
+            l_r_max.append(float(config["config_particles"]["r_max"]))
+    if len(l_r_max) == 0:
+        raise FileNotFoundError(f"No base collider configuration found in scans/{study_name}.")
+    return max(l_r_max)
+
+
+def get_da_of_points(df_points):
+    # Minimal DA over both beams of each working point. Working points without any lost particle are
+    # not in da.parquet: their DA is at least the largest tracked amplitude, which is used instead
+    df_da = pd.read_parquet(f"scans/{study_name}/da.parquet").reset_index(drop=True)
+    df_da[l_refined_dimensions] = df_da[l_refined_dimensions].astype(float).round(decimals)
+    df_da = df_da.groupby(l_refined_dimensions)["normalized amplitude in xy-plane"].min()
+    df_points = df_points.merge(df_da.reset_index(), on=l_refined_dimensions, how="left")
+    df_points = df_points.rename(columns={"normalized amplitude in xy-plane": "DA"})
+    df_points["DA"] = df_points["DA"].fillna(get_max_tracked_amplitude())
+    return df_points
+
+
+def get_distance_to_resonances(qx, qy):
+    # Distance of each working point to the closest resonance line m * qx + n * qy = p, with
+    # |m| + |n| <= resonance_order
+    l_m_n = [
+        (m, n)
+        for m in range(resonance_order + 1)
+        for n in range(-resonance_order, resonance_order + 1)
+        if 0 < m + abs(n) <= resonance_order and (m > 0 or n > 0)
+    ]
+    if len(l_m_n) == 0:
+        return np.full(len(qx), np.inf)
+    array_m, array_n = np.array(l_m_n).T
+    values = np.outer(qx, array_m) + np.outer(qy, array_n)
+    distances = np.abs(values - np.round(values)) / np.sqrt(array_m**2 + array_n**2)
+    return distances.min(axis=1)
+
+
+def get_new_points(df_points):
+    # Midpoints of the pairs of neighbouring working points to refine, along each refined dimension,
+    # with the absolute difference of DA of the pair (used to prioritize the new points)
+    df_points["near_resonance"] = False
+    if resonance_order > 0:
+        df_points["near_resonance"] = (
+            get_distance_to_resonances(df_points["qx"], df_points["qy"]) < resonance_distance
+        )
+
+    l_df_new_points = []
+    for dimension in l_refined_dimensions:
+        # Neighbours are consecutive points along the dimension, all other dimensions being equal
+        l_other_dimensions = [name for name in l_refined_dimensions if name != dimension]
+        df_sorted = df_points.sort_values(l_other_dimensions + [dimension])
+        if len(l_other_dimensions) > 0:
+            df_next = df_sorted.groupby(l_other_dimensions)[
+                [dimension, "DA", "near_resonance"]
+            ].shift(-1)
+        else:
+            df_next = df_sorted[[dimension, "DA", "near_resonance"]].shift(-1)
+
+        delta_da = (df_next["DA"] - df_sorted["DA"]).abs()
+        near_resonance = df_sorted["near_resonance"] | df_next["near_resonance"].eq(True)
+        to_refine = (df_next[dimension] - df_sorted[dimension] >= 2 * min_step) & (
+            (delta_da > da_threshold) | near_resonance
+        )
+
+        df_new_points = df_sorted.loc[to_refine, l_refined_dimensions].copy()
+        df_new_points[dimension] = (df_sorted[dimension] + df_next[dimension])[to_refine] / 2
+        df_new_points["delta_DA"] = delta_da[to_refine]
+        l_df_new_points.append(df_new_points)
+
+    df_new_points = pd.concat(l_df_new_points)
+    df_new_points[l_refined_dimensions] = df_new_points[l_refined_dimensions].round(decimals)
+
+    # Keep each new point once (with its largest difference of DA), and remove the existing ones
+    df_new_points = df_new_points.sort_values("delta_DA", ascending=False, kind="stable")
+    df_new_points = df_new_points.drop_duplicates(subset=l_refined_dimensions)
+    df_new_points = df_new_points.merge(
+        df_points[l_refined_dimensions], on=l_refined_dimensions, how="left", indicator=True
+    )
+    return df_new_points[df_new_points["_merge"] == "left_only"].drop(columns="_merge")
+
+
+# ==================================================================================================
+# --- Refine the scan
+# ==================================================================================================
+if __name__ == "__main__":
+    d_scan = yaml.safe_load(open("config.yaml"))["scan"]
+
+    # Get the working points of the scan and their DA
+    df_points = get_da_of_points(get_existing_points(d_scan))
+    n_points_remaining = max_points_total - len(df_points)
+    print(f"Scan of {len(df_points)} working points, budget of {max_points_total} working points.")
+
+    # Get the new working points, respecting the constraints of the scan and the budget
+    df_new_points = get_new_points(df_points)
+    d_new_points = {name: df_new_points[name].to_numpy() for name in l_refined_dimensions}
+    mask = evaluate_scan_constraints(
+        d_new_points, d_scan.get("constraints", None) or [], len(df_new_points)
+    )
+    n_new_points = max(min(max_points_per_stage, n_points_remaining), 0)
+    df_new_points = df_new_points[mask].iloc[:n_new_points]
+
+    # Store the new working points
+    if n_points_remaining <= 0:
+        print("Budget of working points reached, the scan is not refined anymore.")
+    elif len(df_new_points) == 0:
+        print("No working point to add, the scan is not refined anymore.")
+    else:
+        l_new_points = [
+            {name: float(point[name]) for name in l_refined_dimensions}
+            for _, point in df_new_points.iterrows()
+        ]
+        stage = store_refined_points(study_name, l_new_points)
+        print(f"Stage {stage} of the refinement: {len(l_new_points)} working points added.")
+        print("Run 001_make_folders.py and 002_chronjob.py to submit the corresponding jobs.")
@@ -0,0 +1 @@
+master_jobs/2_configure_and_track/configuration.py
\ No newline at end of file
@@ -0,0 +1 @@
+master_jobs/2_configure_and_track/filling_scheme_store.py
\ No newline at end of file
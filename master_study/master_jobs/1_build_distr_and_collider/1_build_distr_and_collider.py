@@ -1,24 +1,34 @@
 """This script is used to build the base collider with Xmask, configuring only the optics. Functions
 in this script are called sequentially."""
+
 # ==================================================================================================
 # --- Imports
 # ==================================================================================================
 from cpymad.madx import Madx
 import os
 import xmask as xm
+import xobjects as xo
+import xtrack as xt
+import xfields as xf
+import xpart as xp
 import xmask.lhc as xlhc
 import shutil
 import json
+import hashlib
 import yaml
 import logging
 import numpy as np
 import itertools
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import tree_maker
 
 # Import user-defined optics-specific tools
 import optics_specific_tools as ost
 
+# Import collider serialization tools
+from collider_io import get_collider_extension, save_collider
+
 
 # ==================================================================================================
 # --- Function for tree_maker tagging
@@ -71,7 +81,19 @@ def build_particle_distribution(config_particles):
 
     # Split distribution into several chunks for parallelization
     n_split = config_particles["n_split"]
-    particle_list = list(np.array_split(particle_list, n_split))
+    if config_particles.get("split_by_angle", False):
+        # Keep all the amplitudes of a given angle in the same chunk (required for the adaptive
+        # search of the DA boundary, which is done angle by angle)
+        if n_split > n_angles:
+            raise ValueError(
+                f"Can't split {n_angles} angles into {n_split} chunks. Please decrease n_split."
+            )
+        n_angles_per_chunk = [len(l) for l in np.array_split(theta_list, n_split)]
+        particle_list = np.split(
+            np.array(particle_list), np.cumsum(n_angles_per_chunk)[:-1] * len(radial_list)
+        )
+    else:
+        particle_list = list(np.array_split(particle_list, n_split))
 
     # Return distribution
     return particle_list
@@ -91,21 +113,30 @@ def write_particle_distribution(particle_list):
 # ==================================================================================================
 # --- Function to build collider from mad model
 # ==================================================================================================
-def build_collider_from_mad(config_mad, sanity_checks=True):
-    # Make mad environment
-    xm.make_mad_environment(links=config_mad["links"])
-
-    # Start mad
-    mad_b1b2 = Madx(command_log="mad_collider.log")
-
-    mad_b4 = Madx(command_log="mad_b4.log")
+def make_mad_session_folder(session_folder, config_mad):
+    # Each mad session runs in its own folder, containing only links to the mad environment (and to
+    # the errors), such that sessions running concurrently never write to the same files (e.g. in the
+    # temp folder)
+    os.makedirs(f"{session_folder}/temp", exist_ok=True)
+    d_links = {
+        **config_mad["links"],
+        "errors": os.path.join(os.path.dirname(xlhc.__file__), "lhcerrors"),
+    }
+    for name, target in d_links.items():
+        if not os.path.lexists(f"{session_folder}/{name}"):
+            os.symlink(os.path.abspath(target), f"{session_folder}/{name}")
+
+
+def build_mad_b1b2(config_mad, sanity_checks=True):
+    # Start mad in its own folder
+    make_mad_session_folder("mad_b1b2", config_mad)
+    mad_b1b2 = Madx(command_log="mad_collider.log", cwd="mad_b1b2")
 
     # Build sequences
     ost.build_sequence(mad_b1b2, mylhcbeam=1)
-    ost.build_sequence(mad_b4, mylhcbeam=4)
 
     # Apply optics (only for b1b2, b4 will be generated from b1b2)
-    ost.apply_optics(mad_b1b2, optics_file=config_mad["optics_file"])
+    ost.apply_optics(mad_b1b2, optics_file=os.path.abspath(config_mad["optics_file"]))
 
     if sanity_checks:
         mad_b1b2.use(sequence="lhcb1")
@@ -115,11 +146,36 @@ def build_collider_from_mad(config_mad, sanity_checks=True):
         mad_b1b2.twiss()
         ost.check_madx_lattices(mad_b1b2)
 
+    return mad_b1b2
+
+
+def build_mad_b4(config_mad, sanity_checks=True):
+    # Start mad in its own folder
+    make_mad_session_folder("mad_b4", config_mad)
+    mad_b4 = Madx(command_log="mad_b4.log", cwd="mad_b4")
+
+    # Build sequences
+    ost.build_sequence(mad_b4, mylhcbeam=4)
+
     # Apply optics (only for b4, just for check)
-    ost.apply_optics(mad_b4, optics_file=config_mad["optics_file"])
+    ost.apply_optics(mad_b4, optics_file=os.path.abspath(config_mad["optics_file"]))
     if sanity_checks:
         mad_b4.use(sequence="lhcb2")
         mad_b4.twiss()
+
+    return mad_b4
+
+
+def build_collider_from_mad(config_mad, sanity_checks=True):
+    # Build the two mad models concurrently. Each Madx instance runs in its own process (and folder),
+    # so threads are enough to drive them in parallel while keeping the sequences available here
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_b1b2 = executor.submit(build_mad_b1b2, config_mad, sanity_checks)
+        future_b4 = executor.submit(build_mad_b4, config_mad, sanity_checks)
+        mad_b1b2 = future_b1b2.result()
+        mad_b4 = future_b4.result()
+
+    if sanity_checks:
         ost.check_madx_lattices(mad_b1b2)
 
     # Build xsuite collider
@@ -173,13 +229,148 @@ def activate_RF_and_twiss(collider, config_mad, sanity_checks=True):
     return collider
 
 
+# ==================================================================================================
+# --- Function to install beam-beam in the base collider
+# ==================================================================================================
+# Parameters of the beam-beam lenses installation
+BEAMBEAM_INSTALL_KEYS = [
+    "num_long_range_encounters_per_side",
+    "num_slices_head_on",
+    "bunch_spacing_buckets",
+    "sigma_z",
+]
+
+
+def install_beam_beam(collider, config_bb_install):
+    # Install beam-beam lenses (inactive and not configured), as done in generation 2
+    collider.install_beambeam_interactions(
+        clockwise_line="lhcb1",
+        anticlockwise_line="lhcb2",
+        ip_names=["ip1", "ip2", "ip5", "ip8"],
+        delay_at_ips_slots=[0, 891, 0, 2670],
+        num_long_range_encounters_per_side=config_bb_install["num_long_range_encounters_per_side"],
+        num_slices_head_on=config_bb_install["num_slices_head_on"],
+        harmonic_number=35640,
+        bunch_spacing_buckets=config_bb_install["bunch_spacing_buckets"],
+        sigmaz=config_bb_install["sigma_z"],
+    )
+
+    # Record the installation parameters, such that generation 2 can check them
+    collider.metadata["beambeam_install"] = {
+        key: config_bb_install[key] for key in BEAMBEAM_INSTALL_KEYS
+    }
+
+    return collider
+
+
+# ==================================================================================================
+# --- Function to compute the response of the tune and chromaticity to the tuning knobs
+# ==================================================================================================
+# Tuning knobs, steps used for the finite differences (as in the xmask matching), and observables
+TUNE_CHROMA_KNOBS = ["q_knob_1", "q_knob_2", "dq_knob_1", "dq_knob_2"]
+TUNE_CHROMA_STEPS = [1e-5, 1e-5, 1e-2, 1e-2]
+TUNE_CHROMA_OBSERVABLES = ["qx", "qy", "dqx", "dqy"]
+
+
+def compute_tune_chroma_response(collider, config_response):
+    # Compute the Jacobian of the tune and chromaticity with respect to the tuning knobs, with
+    # centered finite differences
+    d_response = {}
+    for line_name in ["lhcb1", "lhcb2"]:
+        knob_names = config_response["knob_names"][line_name]
+        l_knobs = [knob_names[knob] for knob in TUNE_CHROMA_KNOBS]
+        jacobian = np.zeros((len(TUNE_CHROMA_OBSERVABLES), len(l_knobs)))
+        for idx_knob, (knob, step) in enumerate(zip(l_knobs, TUNE_CHROMA_STEPS)):
+            expr = collider.vars[knob]._expr
+            value = collider.vars[knob]._value
+            l_observables = []
+            for sign in [1, -1]:
+                collider.vars[knob] = value + sign * step
+                tw = collider[line_name].twiss()
+                l_observables.append(np.array([tw[obs] for obs in TUNE_CHROMA_OBSERVABLES]))
+            jacobian[:, idx_knob] = (l_observables[0] - l_observables[1]) / (2 * step)
+
+            # Restore the knob
+            collider.vars[knob] = expr if expr is not None else value
+
+        d_response[line_name] = {
+            "knobs": l_knobs,
+            "observables": TUNE_CHROMA_OBSERVABLES,
+            "jacobian": jacobian.tolist(),
+        }
+
+    return d_response
+
+
 def clean():
-    # Remove all the temporaty files created in the process of building collider
-    os.remove("mad_collider.log")
-    os.remove("mad_b4.log")
-    shutil.rmtree("temp")
-    os.unlink("errors")
-    os.unlink("acc-models-lhc")
+    # Remove all the temporaty files created in the process of building collider (the mad files
+    # don't exist if the collider has been taken from the cache)
+    for path in ["mad_collider.log", "mad_b4.log", "errors", "acc-models-lhc"]:
+        if os.path.lexists(path):
+            os.unlink(path)
+    shutil.rmtree("temp", ignore_errors=True)
+    for session_folder in ["mad_b1b2", "mad_b4"]:
+        shutil.rmtree(session_folder, ignore_errors=True)
+
+
+# ==================================================================================================
+# --- Functions to share base colliders between studies
+# ==================================================================================================
+# Files (relative to the mad environment) used to build the collider, on top of the optics file
+BASE_COLLIDER_FILES = [
+    "optics_specific_tools.py",
+    "acc-models-lhc/lhc.seq",
+    "acc-models-lhc/lhcb4.seq",
+    "acc-models-lhc/hllhc_sequence.madx",
+    "acc-models-lhc/toolkit/macro.madx",
+    "acc-models-lhc/toolkit/enable_crabcavities.madx",
+]
+
+
+def get_base_collider_hash(config_mad, l_configs=[]):
+    # Hash the mad configuration along with the versions of the packages building the collider and
+    # the content of the files used to build it. The links are not hashed as such, since only the
+    # content of the files they point to matters. The files called from within the optics file are
+    # not known, so all the files of the folder of the optics file are hashed (the other files called
+    # by the optics file, if any, are not)
+    hash_object = hashlib.sha256()
+    config_mad_to_hash = {key: value for key, value in config_mad.items() if key != "links"}
+    versions = [xm.__version__, xt.__version__, xf.__version__, xp.__version__, xo.__version__]
+    hash_object.update(
+        json.dumps([config_mad_to_hash, l_configs, versions], sort_keys=True).encode()
+    )
+    optics_folder = os.path.dirname(config_mad["optics_file"]) or "."
+    l_optics_files = sorted(
+        f"{optics_folder}/{filename}"
+        for filename in os.listdir(optics_folder)
+        if os.path.isfile(f"{optics_folder}/{filename}")
+    )
+    for path in l_optics_files + BASE_COLLIDER_FILES:
+        if os.path.isfile(path):
+            hash_object.update(path.encode())
+            with open(path, "rb") as fid:
+                for chunk in iter(lambda: fid.read(2**20), b""):
+                    hash_object.update(chunk)
+    return hash_object.hexdigest()
+
+
+def get_base_collider_from_cache(cache_folder, hash_config, l_paths):
+    # Copy the cached collider files to l_paths, returns False if they're not all in the cache
+    l_cached_paths = [f"{cache_folder}/{hash_config}/{os.path.basename(path)}" for path in l_paths]
+    if not all(os.path.isfile(cached_path) for cached_path in l_cached_paths):
+        return False
+    for cached_path, path in zip(l_cached_paths, l_paths):
+        shutil.copyfile(cached_path, path)
+    return True
+
+
+def store_base_collider_in_cache(cache_folder, hash_config, l_paths):
+    # Copy through temporary files, such that other studies never read an incomplete collider
+    os.makedirs(f"{cache_folder}/{hash_config}", exist_ok=True)
+    for path in l_paths:
+        cached_path = f"{cache_folder}/{hash_config}/{os.path.basename(path)}"
+        shutil.copyfile(path, f"{cached_path}.tmp.{os.getpid()}")
+        os.replace(f"{cached_path}.tmp.{os.getpid()}", cached_path)
 
 
 # ==================================================================================================
@@ -201,18 +392,52 @@ def build_distr_and_collider(config_file="config.yaml"):
     # Write particle distribution to file
     write_particle_distribution(particle_list)
 
-    # Build collider from mad model
-    collider = build_collider_from_mad(config_mad, sanity_checks)
+    # Make mad environment
+    xm.make_mad_environment(links=config_mad["links"])
 
-    # Twiss to ensure eveyrthing is ok
-    collider = activate_RF_and_twiss(collider, config_mad, sanity_checks)
+    # Get the base collider from the cache if it has already been built (e.g. in another study)
+    os.makedirs("collider", exist_ok=True)
+    extension = get_collider_extension(config_mad.get("collider_format", "json"))
+    l_paths = [f"collider/collider.{extension}"]
+    config_response = configuration.get("tune_chroma_response", None)
+    if config_response is not None:
+        l_paths.append("collider/tune_chroma_response.json")
+    config_bb_install = configuration.get("config_beambeam_install", None)
+    cache_folder = configuration.get("base_collider_cache", None)
+    collider_from_cache = False
+    if cache_folder is not None:
+        hash_config = get_base_collider_hash(config_mad, [config_response, config_bb_install])
+        collider_from_cache = get_base_collider_from_cache(cache_folder, hash_config, l_paths)
+        if collider_from_cache:
+            print(f"Base collider {hash_config} taken from cache")
+
+    if not collider_from_cache:
+        # Build collider from mad model
+        collider = build_collider_from_mad(config_mad, sanity_checks)
+
+        # Twiss to ensure eveyrthing is ok
+        collider = activate_RF_and_twiss(collider, config_mad, sanity_checks)
+
+        # Compute the response of the tune and chromaticity to the tuning knobs
+        if config_response is not None:
+            d_response = compute_tune_chroma_response(collider, config_response)
+            with open("collider/tune_chroma_response.json", "w") as fid:
+                json.dump(d_response, fid, indent=4)
+
+        # Install beam-beam lenses if requested
+        if config_bb_install is not None:
+            collider = install_beam_beam(collider, config_bb_install)
 
     # Clean temporary files
     clean()
 
-    # Save collider to json
-    os.makedirs("collider", exist_ok=True)
-    collider.to_json("collider/collider.json")
+    if not collider_from_cache:
+        # Save collider (to json or binary format)
+        save_collider(collider, l_paths[0])
+
+        # Store collider in the cache for future studies
+        if cache_folder is not None:
+            store_base_collider_in_cache(cache_folder, hash_config, l_paths)
 
     # Tag end of the job
     tree_maker_tagging(configuration, tag="completed")
@@ -0,0 +1 @@
+../2_configure_and_track/collider_io.py
\ No newline at end of file
@@ -1,6 +1,11 @@
+import threading
 from xmask.lhc import install_errors_placeholders_hllhc
 import numpy as np
 
+# The installation of the error placeholders (re)creates a link in the current directory, which must
+# not be done by several mad sessions at the same time
+_lock_errors_placeholders = threading.Lock()
+
 
 def check_madx_lattices(mad):
     assert mad.globals["qxb1"] == mad.globals["qxb2"]
@@ -94,7 +99,8 @@ def build_sequence(
       beam,particle=proton,sequence=lhcb2,energy=nrj,bv = -1,npart=1.15E11,sige=4.5e-4;
       """)
 
-    install_errors_placeholders_hllhc(mad)
+    with _lock_errors_placeholders:
+        install_errors_placeholders_hllhc(mad)
 
     if not ignore_cycling:
         mad.input("""
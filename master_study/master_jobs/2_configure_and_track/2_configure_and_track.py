@@ -6,22 +6,47 @@ simple scripting for reproducibility, to allow rebuilding the collider from a di
 # --- Imports
 # ==================================================================================================
 import json
+import copy
+import itertools
 import ruamel.yaml
 import time
 import logging
+import multiprocessing
 import numpy as np
 import pandas as pd
 import os
+import shutil
 import xtrack as xt
 import tree_maker
 import xmask as xm
 import xmask.lhc as xlhc
 from misc import generate_orbit_correction_setup
 from misc import luminosity_leveling, luminosity_leveling_ip1_5, compute_PU
+from misc import ColliderSnapshot, TwissCache, get_twiss, get_knob_values, set_knob_values
+from misc import get_bunches_with_unique_schedules
+from collider_io import load_collider
+from configuration import materialize_child_configuration
+from filling_scheme_store import load_filling_scheme
+from study_cache import (
+    get_hash,
+    get_knob_store_context_hash,
+    get_knob_store_point,
+    get_path_lock_configured_collider,
+    load_configured_collider,
+    load_nearest_knobs,
+    load_or_build_track_kernel,
+    release_lock,
+    store_configured_collider,
+    store_knobs,
+    wait_for_configured_collider,
+)
 
 # Initialize yaml reader
 ryaml = ruamel.yaml.YAML()
 
+# Collider shared with the tracking worker processes (inherited when the workers are forked)
+_line_for_workers = None
+
 
 # ==================================================================================================
 # --- Function for tree_maker tagging
@@ -50,6 +75,11 @@ def read_configuration(config_path="config.yaml"):
         with open("../1_build_distr_and_collider/" + config_path, "r") as fid:
             config_gen_1 = ryaml.load(fid)
 
+    # Materialize the full configuration if the job only contains the parameters overriding the
+    # default configuration of the children (stored in the previous generation). The full
+    # configuration is then dumped by the job, such that this is only done once
+    config = materialize_child_configuration(config, config_gen_1)
+
     config_mad = config_gen_1["config_mad"]
     return config, config_mad
 
@@ -70,6 +100,19 @@ def install_beam_beam(collider, config_collider):
     # Load config
     config_bb = config_collider["config_beambeam"]
 
+    # Don't install the lenses again if they've been installed in the base collider (generation 1),
+    # but make sure that it's been done with the same parameters
+    if "beambeam_install" in collider.metadata:
+        config_bb_install = collider.metadata["beambeam_install"]
+        for key, value in config_bb_install.items():
+            if json.dumps(value, sort_keys=True) != json.dumps(config_bb[key], sort_keys=True):
+                raise ValueError(
+                    f"Beam-beam lenses installed in the base collider with {key}={value}, but"
+                    f" {key}={config_bb[key]} is requested."
+                )
+        print("Beam-beam lenses already installed in the base collider")
+        return collider, config_bb
+
     # Install beam-beam lenses (inactive and not configured)
     collider.install_beambeam_interactions(
         clockwise_line="lhcb1",
@@ -101,7 +144,75 @@ def set_knobs(config_collider, collider):
     return collider, conf_knobs_and_tuning
 
 
-def match_tune_and_chroma(collider, conf_knobs_and_tuning, match_linear_coupling_to_zero=True):
+def get_matched_knob_names(config_collider):
+    # Knobs varied by the tune, chromaticity and coupling matching
+    l_knobs = [
+        knob
+        for line_name in ["lhcb1", "lhcb2"]
+        for knob in config_collider["config_knobs_and_tuning"]["knob_names"][line_name].values()
+    ]
+
+    # Knobs varied by the leveling
+    if "config_lumi_leveling" in config_collider and not config_collider["skip_leveling"]:
+        for config_this_ip in config_collider["config_lumi_leveling"].values():
+            l_knobs += config_this_ip["knobs"] + config_this_ip["corrector_knob_names"]
+
+    return l_knobs
+
+
+def load_tune_chroma_response(config_sim, conf_knobs_and_tuning):
+    # Load the response of the tune and chromaticity to the tuning knobs (computed in generation 1),
+    # if available and computed for the same knobs
+    response_file = config_sim.get("tune_chroma_response_file", None)
+    if response_file is None:
+        return None
+    if not os.path.isfile(response_file):
+        print(f"Tune and chromaticity response {response_file} not found, ignoring it.")
+        return None
+
+    with open(response_file, "r") as fid:
+        tune_chroma_response = json.load(fid)
+
+    for line_name in ["lhcb1", "lhcb2"]:
+        knob_names = conf_knobs_and_tuning["knob_names"][line_name]
+        l_knobs = [knob_names[knob] for knob in ["q_knob_1", "q_knob_2", "dq_knob_1", "dq_knob_2"]]
+        if tune_chroma_response[line_name]["knobs"] != l_knobs:
+            print("Tune and chromaticity response computed for other knobs, ignoring it.")
+            return None
+
+    return tune_chroma_response
+
+
+def retune_with_response(collider, line_name, targets, response, n_iterations=3, twiss_cache=None):
+    # Newton iterations using the precomputed response, returns True if the tune and chromaticity
+    # are within tolerance (otherwise the knobs are restored)
+    d_tolerances = {"qx": 1e-5, "qy": 1e-5, "dqx": 1e-2, "dqy": 1e-2}
+    l_observables = response["observables"]
+    jacobian = np.array(response["jacobian"])
+    d_knobs_initial = {knob: collider.vars[knob]._value for knob in response["knobs"]}
+    for idx_iteration in range(n_iterations + 1):
+        tw = get_twiss(collider, line_name, twiss_cache)
+        errors = np.array([targets[obs] - tw[obs] for obs in l_observables])
+        if all(abs(errors[i]) < d_tolerances[obs] for i, obs in enumerate(l_observables)):
+            print(f"Retuned {line_name} with the response matrix in {idx_iteration} iteration(s)")
+            return True
+        if idx_iteration < n_iterations:
+            delta_knobs = np.linalg.solve(jacobian, errors)
+            for knob, delta in zip(response["knobs"], delta_knobs):
+                collider.vars[knob] = collider.vars[knob]._value + delta
+
+    for knob, value in d_knobs_initial.items():
+        collider.vars[knob] = value
+    return False
+
+
+def match_tune_and_chroma(
+    collider,
+    conf_knobs_and_tuning,
+    match_linear_coupling_to_zero=True,
+    tune_chroma_response=None,
+    twiss_cache=None,
+):
     # Tunings
     for line_name in ["lhcb1", "lhcb2"]:
         knob_names = conf_knobs_and_tuning["knob_names"][line_name]
@@ -113,6 +224,27 @@ def match_tune_and_chroma(collider, conf_knobs_and_tuning, match_linear_coupling
             "dqy": conf_knobs_and_tuning["dqy"][line_name],
         }
 
+        # If the response is available, only correct the orbit (and coupling) with a matching, and
+        # retune from the response. Do the full matching if it fails
+        if tune_chroma_response is not None:
+            xm.machine_tuning(
+                line=collider[line_name],
+                enable_closed_orbit_correction=True,
+                enable_linear_coupling_correction=match_linear_coupling_to_zero,
+                knob_names=knob_names,
+                line_co_ref=collider[line_name + "_co_ref"],
+                co_corr_config=conf_knobs_and_tuning["closed_orbit_correction"][line_name],
+            )
+            if retune_with_response(
+                collider,
+                line_name,
+                targets,
+                tune_chroma_response[line_name],
+                twiss_cache=twiss_cache,
+            ):
+                continue
+            print(f"Retuning {line_name} with the response matrix failed, doing the full matching")
+
         xm.machine_tuning(
             line=collider[line_name],
             enable_closed_orbit_correction=True,
@@ -135,10 +267,9 @@ def compute_collision_from_scheme(config_bb):
     # Get the filling scheme path (in json or csv format)
     filling_scheme_path = config_bb["mask_with_filling_pattern"]["pattern_fname"]
 
-    # Load the filling scheme
+    # Load the filling scheme (the number of collisions is precomputed in the store)
     if filling_scheme_path.endswith(".json"):
-        with open(filling_scheme_path, "r") as fid:
-            filling_scheme = json.load(fid)
+        filling_scheme = load_filling_scheme(filling_scheme_path)
     else:
         raise ValueError(
             f"Unknown filling scheme file format: {filling_scheme_path}. It you provided a csv"
@@ -146,17 +277,11 @@ def compute_collision_from_scheme(config_bb):
             " 001_make_folders.py. Something went wrong."
         )
 
-    # Extract booleans beam arrays
-    array_b1 = np.array(filling_scheme["beam1"])
-    array_b2 = np.array(filling_scheme["beam2"])
-
-    # Assert that the arrays have the required length, and do the convolution
-    assert len(array_b1) == len(array_b2) == 3564
-    n_collisions_ip1_and_5 = array_b1 @ array_b2
-    n_collisions_ip2 = np.roll(array_b1, 891) @ array_b2
-    n_collisions_ip8 = np.roll(array_b1, 2670) @ array_b2
-
-    return n_collisions_ip1_and_5, n_collisions_ip2, n_collisions_ip8
+    return (
+        filling_scheme["n_collisions_ip1_and_5"],
+        filling_scheme["n_collisions_ip2"],
+        filling_scheme["n_collisions_ip8"],
+    )
 
 
 # ==================================================================================================
@@ -170,6 +295,7 @@ def do_levelling(
     collider,
     n_collisions_ip1_and_5,
     crab,
+    twiss_cache=None,
 ):
     # Read knobs and tuning settings from config file (already updated with the number of collisions)
     config_lumi_leveling = config_collider["config_lumi_leveling"]
@@ -197,6 +323,7 @@ def do_levelling(
                     config_collider,
                     config_bb,
                     crab=crab,
+                    twiss_cache=twiss_cache,
                 )
             except ValueError:
                 print("There was a problem during the luminosity leveling in IP1/5... Ignoring it.")
@@ -265,9 +392,9 @@ def add_linear_coupling(conf_knobs_and_tuning, collider, config_mad):
 # --- Function to assert that tune, chromaticity and linear coupling are correct before beam-beam
 #     configuration
 # ==================================================================================================
-def assert_tune_chroma_coupling(collider, conf_knobs_and_tuning):
+def assert_tune_chroma_coupling(collider, conf_knobs_and_tuning, twiss_cache=None):
     for line_name in ["lhcb1", "lhcb2"]:
-        tw = collider[line_name].twiss()
+        tw = get_twiss(collider, line_name, twiss_cache)
         assert np.isclose(tw.qx, conf_knobs_and_tuning["qx"][line_name], atol=1e-4), (
             f"tune_x is not correct for {line_name}. Expected"
             f" {conf_knobs_and_tuning['qx'][line_name]}, got {tw.qx}"
@@ -313,6 +440,13 @@ def configure_beam_beam(collider, config_bb):
         nemitt_y=config_bb["nemitt_y"],
     )
 
+    # Configure filling scheme mask and bunch numbers
+    collider = apply_filling_pattern(collider, config_bb)
+
+    return collider
+
+
+def apply_filling_pattern(collider, config_bb):
     # Configure filling scheme mask and bunch numbers
     if "mask_with_filling_pattern" in config_bb:
         # Initialize filling pattern with empty values
@@ -327,8 +461,7 @@ def configure_beam_beam(collider, config_bb):
             # Fill values if possible
             if config_bb["mask_with_filling_pattern"]["pattern_fname"] is not None:
                 fname = config_bb["mask_with_filling_pattern"]["pattern_fname"]
-                with open(fname, "r") as fid:
-                    filling = json.load(fid)
+                filling = load_filling_scheme(fname)
                 filling_pattern_cw = filling["beam1"]
                 filling_pattern_acw = filling["beam2"]
 
@@ -352,10 +485,10 @@ def configure_beam_beam(collider, config_bb):
 # ==================================================================================================
 # --- Function to compute luminosity once the collider is configured
 # ==================================================================================================
-def record_final_luminosity(collider, config_bb, l_n_collisions, crab):
+def record_final_luminosity(collider, config_bb, l_n_collisions, crab, twiss_cache=None):
     # Get the final luminoisty in all IPs
-    twiss_b1 = collider["lhcb1"].twiss()
-    twiss_b2 = collider["lhcb2"].twiss()
+    twiss_b1 = get_twiss(collider, "lhcb1", twiss_cache)
+    twiss_b2 = get_twiss(collider, "lhcb2", twiss_cache)
     l_lumi = []
     l_PU = []
     l_ip = ["ip1", "ip2", "ip5", "ip8"]
@@ -408,7 +541,7 @@ def configure_collider(
     config_collider = config["config_collider"]
 
     # Rebuild collider
-    collider = xt.Multiline.from_json(config_sim["collider_file"])
+    collider = load_collider(config_sim["collider_file"])
 
     # Install beam-beam
     collider, config_bb = install_beam_beam(collider, config_collider)
@@ -416,12 +549,42 @@ def configure_collider(
     # Build trackers
     collider.build_trackers()
 
+    # Avoid recomputing the twiss on an unchanged machine. The twiss of a line is not invalidated by
+    # the tuning knobs of the other beam, and the cache must be invalidated explicitly when the
+    # elements are modified without knobs (see configure_beam_beam below)
+    d_knob_names = config_collider["config_knobs_and_tuning"]["knob_names"]
+    twiss_cache = TwissCache(
+        collider,
+        d_excluded_knobs={
+            "lhcb1": list(d_knob_names["lhcb2"].values()),
+            "lhcb2": list(d_knob_names["lhcb1"].values()),
+        },
+    )
+
     # Set knobs
     collider, conf_knobs_and_tuning = set_knobs(config_collider, collider)
 
+    # Start the matchings from the knobs of the nearest working point already configured, if any
+    knob_store = config_sim.get("knob_store", None)
+    if knob_store is not None:
+        hash_context = get_knob_store_context_hash(config_collider, config_mad)
+        point = get_knob_store_point(config_collider)
+        d_knobs = load_nearest_knobs(knob_store, hash_context, point)
+        if d_knobs is not None:
+            print("Starting the matchings from the knobs of the nearest working point")
+            for kk, vv in d_knobs.items():
+                collider.vars[kk] = vv
+
+    # Load the response of the tune and chromaticity to the tuning knobs, if available
+    tune_chroma_response = load_tune_chroma_response(config_sim, conf_knobs_and_tuning)
+
     # Match tune and chromaticity
     collider = match_tune_and_chroma(
-        collider, conf_knobs_and_tuning, match_linear_coupling_to_zero=True
+        collider,
+        conf_knobs_and_tuning,
+        match_linear_coupling_to_zero=True,
+        tune_chroma_response=tune_chroma_response,
+        twiss_cache=twiss_cache,
     )
 
     # Compute the number of collisions in the different IPs
@@ -448,6 +611,7 @@ def configure_collider(
             collider,
             n_collisions_ip1_and_5,
             crab,
+            twiss_cache=twiss_cache,
         )
 
     else:
@@ -461,20 +625,38 @@ def configure_collider(
 
     # Rematch tune and chromaticity
     collider = match_tune_and_chroma(
-        collider, conf_knobs_and_tuning, match_linear_coupling_to_zero=False
+        collider,
+        conf_knobs_and_tuning,
+        match_linear_coupling_to_zero=False,
+        tune_chroma_response=tune_chroma_response,
+        twiss_cache=twiss_cache,
     )
 
     # Assert that tune, chromaticity and linear coupling are correct one last time
-    assert_tune_chroma_coupling(collider, conf_knobs_and_tuning)
+    assert_tune_chroma_coupling(collider, conf_knobs_and_tuning, twiss_cache=twiss_cache)
+
+    # Store the matched knobs for the neighbouring working points (knobs controlled by an expression
+    # are left untouched)
+    if knob_store is not None:
+        d_knobs = {
+            kk: float(collider.vars[kk]._value)
+            for kk in get_matched_knob_names(config_collider)
+            if collider.vars[kk]._expr is None
+        }
+        store_knobs(knob_store, hash_context, point, d_knobs)
 
-    # Return twiss and survey before beam-beam if requested
+    # Return the collider before beam-beam if requested, as a snapshot: the collider is not copied,
+    # but the snapshot restores it temporarily to its state before beam-beam, e.g. to get twiss and
+    # survey with collider_before_bb.restored() as collider: ...
     if return_collider_before_bb:
-        print("Saving collider before beam-beam configuration")
-        collider_before_bb = xt.Multiline.from_dict(collider.to_dict())
+        print("Taking a snapshot of the collider before beam-beam configuration")
+        collider_before_bb = ColliderSnapshot(collider)
 
     if not skip_beam_beam:
-        # Configure beam-beam
+        # Configure beam-beam. The lenses are modified directly, not through knobs, so the twiss
+        # cache doesn't see the change and must be invalidated
         collider = configure_beam_beam(collider, config_bb)
+        twiss_cache.invalidate()
 
     # Update configuration with luminosity now that bb is known
     l_n_collisions = [
@@ -483,7 +665,10 @@ def configure_collider(
         n_collisions_ip1_and_5,
         n_collisions_ip8,
     ]
-    config_bb = record_final_luminosity(collider, config_bb, l_n_collisions, crab)
+    config_bb = record_final_luminosity(
+        collider, config_bb, l_n_collisions, crab, twiss_cache=twiss_cache
+    )
+    twiss_cache.report()
 
     # Drop update configuration
     with open(config_path, "w") as fid:
@@ -491,15 +676,7 @@ def configure_collider(
 
     if save_collider:
         # Save the final collider before tracking
-        print('Saving "collider.json')
-        if save_config:
-            config_dict = {
-                "config_mad": config_mad,
-                "config_collider": config_collider,
-            }
-            collider.metadata = config_dict
-        # Dump collider
-        collider.to_json("collider.json")
+        save_configured_collider(collider, config_mad, config_collider, save_config)
 
     if return_collider_before_bb:
         return collider, config_sim, config_bb, collider_before_bb
@@ -507,13 +684,90 @@ def configure_collider(
         return collider, config_sim, config_bb
 
 
+def save_configured_collider(collider, config_mad, config_collider, save_config=False):
+    print('Saving "collider.json')
+    if save_config:
+        config_dict = {
+            "config_mad": config_mad,
+            "config_collider": config_collider,
+        }
+        collider.metadata = config_dict
+    # Dump collider
+    collider.to_json("collider.json")
+
+
+# ==================================================================================================
+# --- Function to configure the collider only once for all the jobs sharing the same configuration
+#     (e.g. the different particle chunks of a working point)
+# ==================================================================================================
+def configure_collider_with_cache(
+    config,
+    config_mad,
+    save_collider=False,
+    save_config=False,
+    config_path="config.yaml",
+):
+    # Configure the collider directly if no cache is provided
+    config_sim = config["config_simulation"]
+    cache_folder = config_sim.get("configured_collider_cache", None)
+    if cache_folder is None:
+        return configure_collider(
+            config,
+            config_mad,
+            save_collider=save_collider,
+            save_config=save_config,
+            config_path=config_path,
+        )
+
+    # Get the hash of the configuration, of the base collider and of the filling scheme (if any)
+    os.makedirs(cache_folder, exist_ok=True)
+    l_files = [config_sim["collider_file"]]
+    config_filling = config["config_collider"]["config_beambeam"].get("mask_with_filling_pattern")
+    if config_filling is not None and config_filling.get("pattern_fname", None) is not None:
+        l_files.append(config_filling["pattern_fname"])
+    hash_config = get_hash([config["config_collider"], config_mad], l_files=l_files)
+
+    # Load the configured collider if it's already in the cache (or being configured by another job)
+    if wait_for_configured_collider(cache_folder, hash_config):
+        print(f"Loading configured collider {hash_config} from cache")
+        collider, config_collider = load_configured_collider(cache_folder, hash_config)
+        config["config_collider"] = config_collider
+        config_bb = config_collider["config_beambeam"]
+
+        # Drop update configuration
+        with open(config_path, "w") as fid:
+            ryaml.dump(config, fid)
+
+        if save_collider:
+            save_configured_collider(collider, config_mad, config_collider, save_config)
+
+        return collider, config_sim, config_bb
+
+    # Otherwise, configure the collider and store it for the other jobs
+    try:
+        collider, config_sim, config_bb = configure_collider(
+            config,
+            config_mad,
+            save_collider=save_collider,
+            save_config=save_config,
+            config_path=config_path,
+        )
+        store_configured_collider(cache_folder, hash_config, collider, config["config_collider"])
+    finally:
+        release_lock(get_path_lock_configured_collider(cache_folder, hash_config))
+
+    return collider, config_sim, config_bb
+
+
 # ==================================================================================================
 # --- Function to prepare particles distribution for tracking
 # ==================================================================================================
-def prepare_particle_distribution(config_sim, collider, config_bb):
+def prepare_particle_distribution(config_sim, collider, config_bb, particle_df=None):
     beam = config_sim["beam"]
 
-    particle_df = pd.read_parquet(config_sim["particle_file"])
+    # Read the distribution from file if it is not provided
+    if particle_df is None:
+        particle_df = pd.read_parquet(config_sim["particle_file"])
 
     r_vect = particle_df["normalized amplitude in xy-plane"].values
     theta_vect = particle_df["angle in xy-plane [deg]"].values * np.pi / 180  # [rad]
@@ -533,63 +787,518 @@ def prepare_particle_distribution(config_sim, collider, config_bb):
 
 
 # ==================================================================================================
-# --- Function to do the tracking
+# --- Functions to checkpoint the tracking (to resume interrupted jobs)
 # ==================================================================================================
-def track(collider, particles, config_sim, save_input_particles=False):
-    # Get beam being tracked
-    beam = config_sim["beam"]
+def checkpointing_enabled(config_sim):
+    # Checkpointing is only done if a number of turns per checkpoint is provided
+    return config_sim.get("n_turns_per_checkpoint", None) is not None
+
+
+def check_checkpointing(config_sim):
+    # The jobs tracking several rounds (adaptive DA search) or several variants (cheap dimensions)
+    # can't be resumed from a checkpoint, so checkpointing can't be requested for them
+    if not checkpointing_enabled(config_sim):
+        return
+    for key in ["adaptive_da", "cheap_dimensions"]:
+        if config_sim.get(key, None) is not None:
+            raise ValueError(
+                f"Checkpointing can't be used with {key}, n_turns_per_checkpoint must be None."
+            )
 
-    # Optimize line for tracking
-    collider[beam].optimize_for_tracking()
+
+def write_checkpoint_configuration(collider, config, config_sim):
+    # Save the values of the knobs of the configured collider and the updated configuration, such
+    # that a restarted job can rebuild the configured collider from the base collider without doing
+    # the matchings again. The collider itself is not saved, since it may trigger overload of afs
+    checkpoint_folder = config_sim["checkpoint_folder"]
+    os.makedirs(checkpoint_folder, exist_ok=True)
+    with open(f"{checkpoint_folder}/knobs.json.tmp", "w") as fid:
+        json.dump(get_knob_values(collider), fid)
+    os.replace(f"{checkpoint_folder}/knobs.json.tmp", f"{checkpoint_folder}/knobs.json")
+    with open(f"{checkpoint_folder}/config.yaml.tmp", "w") as fid:
+        ryaml.dump(config, fid)
+    os.replace(f"{checkpoint_folder}/config.yaml.tmp", f"{checkpoint_folder}/config.yaml")
+
+
+def write_checkpoint_particles(particles, n_turns_done, config_sim):
+    # Save the particles state after the last completed block of turns. Files are first written
+    # under a temporary name and then moved, such that an eviction never leaves a corrupted
+    # checkpoint behind. All the coordinates are saved (not only the independent ones), such that
+    # the resumed tracking is identical to an uninterrupted one
+    checkpoint_folder = config_sim["checkpoint_folder"]
+    particles.to_pandas(compact=False).to_parquet(f"{checkpoint_folder}/particles.parquet.tmp")
+    os.replace(
+        f"{checkpoint_folder}/particles.parquet.tmp", f"{checkpoint_folder}/particles.parquet"
+    )
+    with open(f"{checkpoint_folder}/n_turns_done.json.tmp", "w") as fid:
+        json.dump({"n_turns_done": int(n_turns_done)}, fid)
+    os.replace(
+        f"{checkpoint_folder}/n_turns_done.json.tmp", f"{checkpoint_folder}/n_turns_done.json"
+    )
+    print(f"Checkpoint written after {n_turns_done} turns")
+
+
+def load_checkpoint(config_sim):
+    # Nothing to load if checkpointing is disabled or if the configuration has not been saved yet
+    if not checkpointing_enabled(config_sim):
+        return None
+    checkpoint_folder = config_sim["checkpoint_folder"]
+    if not os.path.isfile(f"{checkpoint_folder}/knobs.json"):
+        return None
+
+    # Load the configuration updated during the configuration, and rebuild the configured collider
+    # from the base collider and the knobs (the beam-beam lenses are configured again, since they
+    # are not controlled by knobs)
+    print(f"Resuming from checkpoint in {checkpoint_folder}")
+    with open(f"{checkpoint_folder}/config.yaml", "r") as fid:
+        config = ryaml.load(fid)
+    with open(f"{checkpoint_folder}/knobs.json", "r") as fid:
+        d_knobs = json.load(fid)
+    collider = load_collider(config["config_simulation"]["collider_file"])
+    collider, config_bb = install_beam_beam(collider, config["config_collider"])
+    collider.build_trackers()
+    set_knob_values(collider, d_knobs)
+    collider = configure_beam_beam(collider, config_bb)
+
+    # Load the particles if at least one block of turns has been completed
+    particles, n_turns_done = load_checkpoint_particles(config_sim)
+
+    return collider, config, particles, n_turns_done
+
+
+def load_checkpoint_particles(config_sim):
+    # Returns no particles if checkpointing is disabled or if no block of turns has been completed
+    particles = None
+    n_turns_done = 0
+    if not checkpointing_enabled(config_sim):
+        return particles, n_turns_done
+    checkpoint_folder = config_sim["checkpoint_folder"]
+    if os.path.isfile(f"{checkpoint_folder}/n_turns_done.json"):
+        with open(f"{checkpoint_folder}/n_turns_done.json", "r") as fid:
+            n_turns_done = json.load(fid)["n_turns_done"]
+        particles = xt.Particles.from_pandas(
+            pd.read_parquet(f"{checkpoint_folder}/particles.parquet")
+        )
+        print(f"{n_turns_done} turns have already been tracked")
+
+    return particles, n_turns_done
+
+
+# ==================================================================================================
+# --- Functions to track the particles over several processes
+# ==================================================================================================
+def _track_chunk(args):
+    # Track a chunk of particles in a worker process, using the line inherited from the parent
+    particles_dict, num_turns = args
+    particles = xt.Particles.from_dict(particles_dict)
+    _line_for_workers.track(particles, turn_by_turn_monitor=False, num_turns=num_turns)
+    return particles.to_dict()
+
+
+def track_turns(line, particles, num_turns, n_workers=1):
+    # Track in the current process if no worker is requested
+    if n_workers <= 1:
+        line.track(particles, turn_by_turn_monitor=False, num_turns=num_turns)
+        return particles
+
+    # Split the particles in chunks, one per worker
+    l_particles_dict = [
+        particles.filter(np.isin(np.arange(particles._capacity), idx_chunk)).to_dict()
+        for idx_chunk in np.array_split(np.arange(particles._capacity), n_workers)
+    ]
+
+    # Track the chunks in parallel. Workers are forked to inherit the configured and optimized
+    # line, including the compiled kernels
+    global _line_for_workers
+    _line_for_workers = line
+    with multiprocessing.get_context("fork").Pool(n_workers) as pool:
+        l_particles_dict = pool.map(
+            _track_chunk, [(particles_dict, num_turns) for particles_dict in l_particles_dict]
+        )
+    _line_for_workers = None
+
+    # Merge the chunks back, in the initial order
+    particles = xt.Particles.merge(
+        [xt.Particles.from_dict(particles_dict) for particles_dict in l_particles_dict]
+    )
+    particles.sort(by="particle_id", interleave_lost_particles=True)
+
+    return particles
+
+
+# ==================================================================================================
+# --- Function to do the tracking
+# ==================================================================================================
+def track(
+    collider,
+    particles,
+    config_sim,
+    save_input_particles=False,
+    n_turns_done=0,
+    optimize_line=True,
+    line=None,
+):
+    # Get line being tracked (by default, the line of the beam in the collider)
+    if line is None:
+        line = collider[config_sim["beam"]]
+
+    # Optimize line for tracking (only needed once if the line is tracked several times), and get the
+    # corresponding kernel from the cache if possible
+    if optimize_line:
+        kernel_cache = config_sim.get("kernel_cache", None)
+        line.optimize_for_tracking(compile=kernel_cache is None)
+        if kernel_cache is not None:
+            load_or_build_track_kernel(line, kernel_cache)
 
     # Save initial coordinates if requested
     if save_input_particles:
         pd.DataFrame(particles.to_dict()).to_parquet("input_particles.parquet")
 
-    # Track
+    # Get the number of turns per block (a single block if checkpointing is disabled)
     num_turns = config_sim["n_turns"]
+    if checkpointing_enabled(config_sim):
+        n_turns_per_block = config_sim["n_turns_per_checkpoint"]
+    else:
+        n_turns_per_block = num_turns
+
+    # Track, block by block, starting from the last completed block
+    num_turns_to_track = num_turns - n_turns_done
     a = time.time()
-    collider[beam].track(particles, turn_by_turn_monitor=False, num_turns=num_turns)
+    while n_turns_done < num_turns:
+        n_turns_block = min(n_turns_per_block, num_turns - n_turns_done)
+        particles = track_turns(
+            line, particles, n_turns_block, n_workers=config_sim.get("n_workers", 1)
+        )
+        n_turns_done += n_turns_block
+
+        # Save the state of the particles, unless tracking is over
+        if checkpointing_enabled(config_sim) and n_turns_done < num_turns:
+            write_checkpoint_particles(particles, n_turns_done, config_sim)
     b = time.time()
 
     print(f"Elapsed time: {b-a} s")
-    print(f"Elapsed time per particle per turn: {(b-a)/particles._capacity/num_turns*1e6} us")
+    print(
+        "Elapsed time per particle per turn:"
+        f" {(b-a)/particles._capacity/max(num_turns_to_track, 1)*1e6} us"
+    )
 
     return particles
 
 
+# ==================================================================================================
+# --- Functions to search adaptively for the DA boundary
+# ==================================================================================================
+def refine_amplitudes(df_tracked, n_r_per_round):
+    # For each angle, get the interval between the last stable amplitude and the first lost one,
+    # and sample it with new amplitudes
+    l_df_refined = []
+    for angle, df_angle in df_tracked.groupby("angle in xy-plane [deg]"):
+        r_vect = df_angle["normalized amplitude in xy-plane"].values
+        lost = df_angle["state"].values != 1
+
+        # Nothing to refine if no particle is lost, or if the first amplitude is already lost
+        if not np.any(lost):
+            continue
+        r_first_lost = np.min(r_vect[lost])
+        r_stable_below = r_vect[~lost & (r_vect < r_first_lost)]
+        if r_stable_below.size == 0:
+            continue
+        r_last_stable = np.max(r_stable_below)
+
+        # Sample the boundary interval (bounds excluded as already tracked)
+        r_refined = np.linspace(r_last_stable, r_first_lost, n_r_per_round + 2)[1:-1]
+        l_df_refined.append(
+            pd.DataFrame(
+                {
+                    "normalized amplitude in xy-plane": r_refined,
+                    "angle in xy-plane [deg]": angle,
+                }
+            )
+        )
+
+    if len(l_df_refined) == 0:
+        return None
+    return pd.concat(l_df_refined, ignore_index=True)
+
+
+def track_adaptive_da(collider, config_sim, config_bb, line=None):
+    # Get parameters of the adaptive search
+    n_rounds = config_sim["adaptive_da"]["n_rounds"]
+    n_r_per_round = config_sim["adaptive_da"]["n_r_per_round"]
+
+    # Particles are tracked in several rounds, which can't be resumed from a checkpoint (see
+    # check_checkpointing)
+    config_sim_rounds = dict(config_sim, n_turns_per_checkpoint=None)
+
+    # The line is optimized for tracking in the first round, and must not depend on the knobs in the
+    # next ones (the distribution is prepared from the collider), so a copy is tracked
+    if line is None:
+        line = collider[config_sim["beam"]].copy()
+        line.build_tracker(compile=False)
+
+    # The first round tracks the initial (coarse) distribution. It must contain all the amplitudes
+    # of each angle (i.e. split_by_angle must be set in generation 1)
+    particle_df = pd.read_parquet(config_sim["particle_file"])
+    l_df_tracked = []
+    for idx_round in range(n_rounds + 1):
+        print(f"--- Adaptive DA search: round {idx_round}, {len(particle_df)} particles")
+        particles = prepare_particle_distribution(config_sim, collider, config_bb, particle_df)
+        particles = track(
+            collider, particles, config_sim_rounds, optimize_line=(idx_round == 0), line=line
+        )
+
+        # Add the initial amplitudes and angles to the output
+        df_round = pd.merge(
+            pd.DataFrame(particles.to_dict()),
+            particle_df[
+                ["particle_id", "normalized amplitude in xy-plane", "angle in xy-plane [deg]"]
+            ],
+            on=["particle_id"],
+        )
+        l_df_tracked.append(df_round)
+
+        # Refine the amplitudes around the first loss of each angle, using all particles tracked
+        # so far
+        if idx_round == n_rounds:
+            break
+        particle_df = refine_amplitudes(pd.concat(l_df_tracked), n_r_per_round)
+        if particle_df is None:
+            print("--- Adaptive DA search: no boundary left to refine")
+            break
+        particle_df["particle_id"] = (
+            np.arange(len(particle_df)) + max(df["particle_id"].max() for df in l_df_tracked) + 1
+        )
+
+    return pd.concat(l_df_tracked, ignore_index=True).sort_values("particle_id")
+
+
+# ==================================================================================================
+# --- Functions to scan, within a job, the dimensions that don't require to configure the collider
+#     again (e.g. octupoles, tracked bunch, momentum offset)
+# ==================================================================================================
+def get_cheap_variants(config_sim):
+    # All the combinations of the values of the cheap dimensions
+    d_cheap_dimensions = config_sim["cheap_dimensions"]
+    return [
+        dict(zip(d_cheap_dimensions.keys(), values))
+        for values in itertools.product(*d_cheap_dimensions.values())
+    ]
+
+
+def expand_bunch_dimensions(config_sim, config_bb):
+    # Bunch dimensions are either a list of bunches, or all_unique_schedules for all the bunches of
+    # the beam. In both cases, only one bunch is tracked per distinct collision schedule. Only the
+    # bunch dimension of the tracked beam is expanded: the bunch of the other beam doesn't change
+    # the tracked line, so its dimension is dropped (its value is then the one of the configuration)
+    d_cheap_dimensions = dict(config_sim["cheap_dimensions"])
+    d_n_bunches_same_schedule = {}
+    for name, beam in [("i_bunch_b1", "lhcb1"), ("i_bunch_b2", "lhcb2")]:
+        if name not in d_cheap_dimensions:
+            continue
+        if beam != config_sim["beam"]:
+            print(f"--- Cheap dimensions: {name} ignored, since {beam} is not tracked")
+            del d_cheap_dimensions[name]
+            continue
+
+        filling = load_filling_scheme(config_bb["mask_with_filling_pattern"]["pattern_fname"])
+        array_b1 = filling["beam1"]
+        array_b2 = filling["beam2"]
+
+        l_bunches = d_cheap_dimensions[name]
+        if l_bunches == "all_unique_schedules":
+            l_bunches = np.flatnonzero(array_b1 if beam == "lhcb1" else array_b2)
+        l_bunches, l_n_bunches = get_bunches_with_unique_schedules(
+            array_b1, array_b2, l_bunches, config_bb, beam=beam
+        )
+        print(f"--- Cheap dimensions: {len(l_bunches)} distinct collision schedules for {name}")
+        d_cheap_dimensions[name] = l_bunches
+        d_n_bunches_same_schedule[name] = dict(zip(l_bunches, l_n_bunches))
+
+    return d_cheap_dimensions, d_n_bunches_same_schedule
+
+
+def apply_cheap_variant(collider, config_sim, config_bb, variant):
+    # Simulation parameters (e.g. delta_max) are changed in the configuration, bunch numbers in the
+    # filling pattern, and all the other dimensions are knobs of the collider. Variants can't be
+    # resumed from a checkpoint (see check_checkpointing)
+    config_sim_variant = dict(config_sim, n_turns_per_checkpoint=None)
+    config_bb_variant = copy.deepcopy(config_bb)
+    update_filling_pattern = False
+    for name, value in variant.items():
+        if name in config_sim:
+            config_sim_variant[name] = value
+        elif name in ["i_bunch_b1", "i_bunch_b2"]:
+            config_bb_variant["mask_with_filling_pattern"][name] = value
+            update_filling_pattern = True
+        else:
+            collider.vars[name] = value
+
+    if update_filling_pattern:
+        collider = apply_filling_pattern(collider, config_bb_variant)
+
+    return config_sim_variant, config_bb_variant
+
+
+def track_cheap_dimensions(collider, config_sim, config_bb):
+    # Kernels are shared between the variants, through a local cache if no other cache is provided
+    if config_sim.get("kernel_cache", None) is None:
+        config_sim = dict(config_sim, kernel_cache="kernels_cheap_dimensions")
+
+    # Track only one bunch per distinct collision schedule
+    d_cheap_dimensions, d_n_bunches_same_schedule = expand_bunch_dimensions(config_sim, config_bb)
+    config_sim = dict(config_sim, cheap_dimensions=d_cheap_dimensions)
+
+    l_df_tracked = []
+    for variant in get_cheap_variants(config_sim):
+        print(f"--- Cheap dimensions: tracking variant {variant}")
+        config_sim_variant, config_bb_variant = apply_cheap_variant(
+            collider, config_sim, config_bb, variant
+        )
+
+        # The optimized line doesn't depend on the knobs anymore, so each variant is optimized and
+        # tracked from a copy of the configured line
+        line = collider[config_sim["beam"]].copy()
+        line.build_tracker(compile=False)
+
+        if config_sim.get("adaptive_da", None) is not None:
+            df_variant = track_adaptive_da(collider, config_sim_variant, config_bb_variant, line)
+        else:
+            particles = prepare_particle_distribution(
+                config_sim_variant, collider, config_bb_variant
+            )
+            particles = track(collider, particles, config_sim_variant, line=line)
+            df_variant = pd.DataFrame(particles.to_dict())
+
+        # Record the values of the cheap dimensions, and the number of bunches represented by the
+        # tracked ones
+        for name, value in variant.items():
+            df_variant[name] = value
+        for name, d_n_bunches in d_n_bunches_same_schedule.items():
+            df_variant[f"n_bunches_same_schedule_{name[-2:]}"] = d_n_bunches[variant[name]]
+        l_df_tracked.append(df_variant)
+
+    return pd.concat(l_df_tracked, ignore_index=True)
+
+
+# ==================================================================================================
+# --- Functions to track one or both beams
+# ==================================================================================================
+def track_beam(collider, config_sim, config_bb, particles=None, n_turns_done=0):
+    # Track all the variants of the cheap dimensions if requested
+    if config_sim.get("cheap_dimensions", None) is not None:
+        return track_cheap_dimensions(collider, config_sim, config_bb)
+
+    # Search adaptively for the DA boundary if requested
+    if config_sim.get("adaptive_da", None) is not None:
+        return track_adaptive_da(collider, config_sim, config_bb)
+
+    # Prepare particle distribution
+    if particles is None:
+        particles = prepare_particle_distribution(config_sim, collider, config_bb)
+
+    # Track
+    particles = track(collider, particles, config_sim, n_turns_done=n_turns_done)
+    return pd.DataFrame(particles.to_dict())
+
+
+def _track_beam_in_process(collider, config_sim, config_bb, output_path):
+    # Track one beam in a forked process, resuming from its own checkpoint if any
+    particles, n_turns_done = load_checkpoint_particles(config_sim)
+    df_particles = track_beam(collider, config_sim, config_bb, particles, n_turns_done)
+    df_particles.to_parquet(output_path)
+
+
+def track_both_beams(collider, config_sim, config_bb):
+    # Each beam is tracked in its own process, forked from the same configured collider, the
+    # workers being shared between the two beams
+    l_processes = []
+    for beam in ["lhcb1", "lhcb2"]:
+        config_sim_beam = dict(
+            config_sim, beam=beam, n_workers=max(config_sim.get("n_workers", 1) // 2, 1)
+        )
+        if checkpointing_enabled(config_sim):
+            config_sim_beam["checkpoint_folder"] = f"{config_sim['checkpoint_folder']}/{beam}"
+            os.makedirs(config_sim_beam["checkpoint_folder"], exist_ok=True)
+        process = multiprocessing.get_context("fork").Process(
+            target=_track_beam_in_process,
+            args=(collider, config_sim_beam, config_bb, f"output_particles_{beam}.parquet"),
+        )
+        process.start()
+        l_processes.append(process)
+
+    for process in l_processes:
+        process.join()
+        if process.exitcode != 0:
+            raise RuntimeError(f"Tracking failed in process {process.pid}.")
+
+    # Gather the output of both beams
+    l_df_particles = []
+    for beam in ["lhcb1", "lhcb2"]:
+        df_particles = pd.read_parquet(f"output_particles_{beam}.parquet")
+        df_particles["beam"] = beam
+        l_df_particles.append(df_particles)
+        os.remove(f"output_particles_{beam}.parquet")
+
+    return pd.concat(l_df_particles, ignore_index=True)
+
+
 # ==================================================================================================
 # --- Main function for collider configuration and tracking
 # ==================================================================================================
 def configure_and_track(config_path="config.yaml"):
     # Get configuration
     config, config_mad = read_configuration(config_path)
+    check_checkpointing(config["config_simulation"])
 
     # Tag start of the job
     tree_maker_tagging(config, tag="started")
 
-    # Configure collider (not saved, since it may trigger overload of afs)
-    collider, config_sim, config_bb = configure_collider(
-        config,
-        config_mad,
-        save_collider=config["dump_collider"],
-        save_config=config["dump_config_in_collider"],
-        config_path=config_path,
-    )
+    # Resume from the last checkpoint if the job has been interrupted
+    checkpoint = load_checkpoint(config["config_simulation"])
+    if checkpoint is not None:
+        collider, config, particles, n_turns_done = checkpoint
+        config_sim = config["config_simulation"]
+        config_bb = config["config_collider"]["config_beambeam"]
 
-    # Prepare particle distribution
-    particles = prepare_particle_distribution(config_sim, collider, config_bb)
+        # Drop the configuration updated during the initial configuration
+        with open(config_path, "w") as fid:
+            ryaml.dump(config, fid)
 
-    # Track
-    particles = track(collider, particles, config_sim)
+    else:
+        # Configure collider (not saved, since it may trigger overload of afs), or get it from the
+        # cache if it has already been configured by another job
+        collider, config_sim, config_bb = configure_collider_with_cache(
+            config,
+            config_mad,
+            save_collider=config["dump_collider"],
+            save_config=config["dump_config_in_collider"],
+            config_path=config_path,
+        )
+
+        # Save the configuration to skip the matchings if the job is restarted
+        if checkpointing_enabled(config_sim):
+            write_checkpoint_configuration(collider, config, config_sim)
+
+        # No particles tracked yet
+        particles = None
+        n_turns_done = 0
+
+    # Track both beams concurrently if requested, or the requested one
+    if config_sim["beam"] == "both":
+        df_particles = track_both_beams(collider, config_sim, config_bb)
+    else:
+        df_particles = track_beam(collider, config_sim, config_bb, particles, n_turns_done)
 
     # Save output
-    pd.DataFrame(particles.to_dict()).to_parquet("output_particles.parquet")
+    df_particles.to_parquet("output_particles.parquet")
 
-    # Remote the correction folder, and potential C files remaining
+    # Remote the correction folder, potential C files remaining, and the checkpoint (job is done)
     try:
         os.system("rm -rf correction")
         os.system("rm -f *.cc")
+        os.system("rm -rf kernels_cheap_dimensions")
+        if checkpointing_enabled(config_sim):
+            shutil.rmtree(config_sim["checkpoint_folder"], ignore_errors=True)
     except:
         pass
 
@@ -0,0 +1,136 @@
+"""This module is used to save and load colliders in a compact binary format, as an alternative to
+json. The file consists of a short header, the compressed json skeleton of the collider (in which
+the numerical arrays are replaced by references), and the raw arrays, which are memory-mapped when
+loading. This module is used by the first generation through a symbolic link, such that there is a
+single source."""
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+import json
+import struct
+import zlib
+import numpy as np
+import xtrack as xt
+
+# ==================================================================================================
+# --- Format definition
+# ==================================================================================================
+# Header: magic string, length of the compressed skeleton, offset of the arrays in the file
+MAGIC = b"XCOLBIN1"
+HEADER_FORMAT = "<8sQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+# Alignment of the arrays in the file [bytes]
+ALIGNMENT = 64
+
+# Key used to flag an array reference in the skeleton
+ARRAY_KEY = "__array__"
+
+
+# ==================================================================================================
+# --- Functions to convert the collider dictionnary into a skeleton and a list of arrays
+# ==================================================================================================
+def _pad(n_bytes):
+    return -n_bytes % ALIGNMENT
+
+
+def _split_arrays(obj, l_arrays, offset):
+    # Replace recursively the numerical arrays by references to their position in the blob
+    if isinstance(obj, dict):
+        d_out = {}
+        for key, value in obj.items():
+            d_out[key], offset = _split_arrays(value, l_arrays, offset)
+        return d_out, offset
+    elif isinstance(obj, (list, tuple)):
+        l_out = []
+        for value in obj:
+            value, offset = _split_arrays(value, l_arrays, offset)
+            l_out.append(value)
+        return l_out, offset
+    elif isinstance(obj, np.ndarray) and obj.dtype.kind in "biufc":
+        array = np.ascontiguousarray(obj)
+        l_arrays.append(array)
+        ref = {ARRAY_KEY: [array.dtype.str, list(array.shape), offset]}
+        return ref, offset + array.nbytes + _pad(array.nbytes)
+    elif isinstance(obj, np.ndarray):
+        return obj.tolist(), offset
+    elif isinstance(obj, np.generic):
+        return obj.item(), offset
+    else:
+        return obj, offset
+
+
+def _join_arrays(obj, blob):
+    # Replace recursively the references by the corresponding (memory-mapped) arrays
+    if isinstance(obj, dict):
+        if ARRAY_KEY in obj:
+            dtype, shape, offset = obj[ARRAY_KEY]
+            dtype = np.dtype(dtype)
+            n_bytes = dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+            return blob[offset : offset + n_bytes].view(dtype).reshape(shape)
+        return {key: _join_arrays(value, blob) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [_join_arrays(value, blob) for value in obj]
+    else:
+        return obj
+
+
+# ==================================================================================================
+# --- Functions to save and load colliders
+# ==================================================================================================
+def collider_to_binary(collider, path):
+    l_arrays = []
+    skeleton, _ = _split_arrays(collider.to_dict(), l_arrays, 0)
+    skeleton = zlib.compress(json.dumps(skeleton).encode())
+    offset_arrays = HEADER_SIZE + len(skeleton) + _pad(HEADER_SIZE + len(skeleton))
+
+    with open(path, "wb") as fid:
+        fid.write(struct.pack(HEADER_FORMAT, MAGIC, len(skeleton), offset_arrays))
+        fid.write(skeleton)
+        fid.write(b"\0" * _pad(HEADER_SIZE + len(skeleton)))
+        for array in l_arrays:
+            fid.write(array.tobytes())
+            fid.write(b"\0" * _pad(array.nbytes))
+
+
+def collider_from_binary(path):
+    with open(path, "rb") as fid:
+        magic, len_skeleton, offset_arrays = struct.unpack(HEADER_FORMAT, fid.read(HEADER_SIZE))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a binary collider file.")
+        skeleton = json.loads(zlib.decompress(fid.read(len_skeleton)))
+        fid.seek(0, 2)
+        size = fid.tell()
+
+    # Map the arrays in copy-on-write mode, such that the file is never modified
+    if size > offset_arrays:
+        blob = np.memmap(path, dtype=np.uint8, mode="c", offset=offset_arrays)
+    else:
+        blob = np.zeros(0, dtype=np.uint8)
+
+    return xt.Multiline.from_dict(_join_arrays(skeleton, blob))
+
+
+def get_collider_extension(collider_format):
+    if collider_format == "json":
+        return "json"
+    elif collider_format == "binary":
+        return "bin"
+    else:
+        raise ValueError(f"Unknown collider format {collider_format}.")
+
+
+def save_collider(collider, path):
+    # Save the collider in the format corresponding to the file extension
+    if path.endswith(".bin"):
+        collider_to_binary(collider, path)
+    else:
+        collider.to_json(path)
+
+
+def load_collider(path):
+    # Load the collider in the format corresponding to the file extension
+    if path.endswith(".bin"):
+        return collider_from_binary(path)
+    else:
+        return xt.Multiline.from_json(path)
@@ -0,0 +1,33 @@
+"""This module is used to merge the configurations of the tree: the children of the second generation
+only store the parameters overriding the default configuration of the children, which is stored in
+the first generation. This module is used by the scripts of the study through a symbolic link, such
+that there is a single source."""
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+import copy
+
+
+# ==================================================================================================
+# --- Functions to merge configurations
+# ==================================================================================================
+def update_configuration(config, config_update):
+    # Recursively update a configuration with another (partial) one
+    for key, value in config_update.items():
+        if isinstance(value, dict) and isinstance(config.get(key, None), dict):
+            update_configuration(config[key], value)
+        else:
+            config[key] = copy.deepcopy(value)
+    return config
+
+
+def materialize_child_configuration(config_child, config_parent):
+    # Get the full configuration of a child only defined by the parameters overriding the default
+    # configuration of the children (stored in the parent)
+    config_child = copy.deepcopy(config_child)
+    if "config_overrides" in config_child:
+        config_child = update_configuration(
+            config_child, config_parent.get("config_children", None) or {}
+        )
+        config_child = update_configuration(config_child, config_child.pop("config_overrides"))
+    return config_child
@@ -0,0 +1,259 @@
+"""This module is used to store filling schemes in a compact binary format, along with the quantities
+derived from them (number of collisions in each IP, head-on and long-range collisions of each bunch,
+bunch trains), such that each scheme is parsed and analysed only once. Entries are indexed by the
+hash of the filling scheme file, and saved in a store folder next to it. This module is used by the
+study folder through a symbolic link, such that there is a single source. Running it as a script
+indexes all the filling schemes of a folder (by default master_jobs/filling_scheme)."""
+# ==================================================================================================
+# --- Imports
+# ==================================================================================================
+import hashlib
+import json
+import os
+import sys
+import numpy as np
+import pandas as pd
+
+# ==================================================================================================
+# --- Store definition
+# ==================================================================================================
+# Number of slots in the LHC
+N_SLOTS = 3564
+
+# Number of long-range collisions considered on each side of the IPs for the stored collision tables
+N_LR_STORE = 26
+
+# Version of the store entries, to be increased whenever their content changes
+STORE_VERSION = 1
+
+# Name of the store folder, located next to the filling schemes
+STORE_FOLDER = "store"
+
+# Filling schemes already loaded by the current process, indexed by path, modification time and size
+_d_loaded_filling_schemes = {}
+
+
+# ==================================================================================================
+# --- Functions to compute the quantities derived from a filling scheme
+# ==================================================================================================
+def _count_in_circular_windows(array, half_width):
+    # Number of filled slots in the window [m - half_width, m + half_width] around each slot m, the
+    # array being circular
+    extended = np.take(
+        np.asarray(array, dtype=int), np.arange(-half_width, len(array) + half_width), mode="wrap"
+    )
+    cumsum = np.concatenate([[0], np.cumsum(extended)])
+    return cumsum[2 * half_width + 1 :] - cumsum[: len(array)]
+
+
+def compute_collision_table(array_b1, array_b2, numberOfLRToConsider=26, beam="beam_1"):
+    """
+    Given the two arrays of booleans of a filling scheme, this function returns, for each bunch of
+    the requested beam, the head-on (HO) and long-range (LR) collisions in each IP. All bunches and
+    IPs are computed at once, using cumulative sums over circular windows. Bunches are ranked by
+    number of long-range collisions, those missing a head-on collision being ranked last.
+    """
+    # Reverse beam order if needed
+    if beam == "beam_1":
+        array_this, array_other = np.array(array_b1), np.array(array_b2)
+        factor = 1
+    elif beam == "beam_2":
+        array_this, array_other = np.array(array_b2), np.array(array_b1)
+        factor = -1
+    else:
+        raise ValueError("beam must be either 'beam_1' or 'beam_2'")
+
+    # Define number of LR to consider
+    if isinstance(numberOfLRToConsider, int):
+        numberOfLRToConsider = [numberOfLRToConsider, numberOfLRToConsider, numberOfLRToConsider]
+
+    # Head-on collision of bunch n (in this beam) with bunch m (in the other beam) if
+    # (n + collide_factor) mod 3564 = m, with collide_factor 891 for ALICE, 0 for ATLAS/CMS and 2670
+    # for LHCb (opposite sign for beam 2)
+    number_of_bunches = len(array_this)
+    bunches = np.flatnonzero(array_this)
+    other_bunches = array_other == 1.0
+    d_table = {"bunch": bunches}
+    for ip, collide_factor, n_LR in zip(
+        ["ip2", "ip1_5", "ip8"], [891, 0, 2670], numberOfLRToConsider
+    ):
+        m = (bunches + factor * collide_factor) % number_of_bunches
+        d_table[f"HO {ip}"] = other_bunches[m]
+        d_table[f"LR {ip}"] = _count_in_circular_windows(other_bunches, n_LR)[m] - other_bunches[m]
+    df_table = pd.DataFrame(d_table)
+    df_table["LR total"] = df_table[["LR ip2", "LR ip1_5", "LR ip8"]].sum(axis=1)
+
+    # If a head-on collision is missing, discard the bunch by setting LR to 0
+    all_HO = df_table[["HO ip2", "HO ip1_5", "HO ip8"]].all(axis=1)
+    df_table["LR for ranking"] = np.where(all_HO, df_table["LR total"], 0)
+
+    # Rank the bunches (the order of the bunches is kept for equal numbers of collisions)
+    df_table = df_table.sort_values("LR for ranking", ascending=False, kind="stable")
+    df_table = df_table.reset_index(drop=True)
+    df_table["rank"] = np.arange(len(df_table))
+
+    return df_table
+
+
+def compute_n_collisions(array_b1, array_b2):
+    # Assert that the arrays have the required length, and do the convolution
+    assert len(array_b1) == len(array_b2) == N_SLOTS
+    n_collisions_ip1_and_5 = array_b1 @ array_b2
+    n_collisions_ip2 = np.roll(array_b1, 891) @ array_b2
+    n_collisions_ip8 = np.roll(array_b1, 2670) @ array_b2
+
+    return n_collisions_ip1_and_5, n_collisions_ip2, n_collisions_ip8
+
+
+def get_bunch_trains(array):
+    # Returns the first slot and the length of each train, the array being circular
+    filled = np.asarray(array) == 1
+    if not filled.any():
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    elif filled.all():
+        return np.array([0]), np.array([len(filled)])
+
+    # Start the search from an empty slot, such that no train is split
+    offset = np.flatnonzero(~filled)[0]
+    edges = np.diff(np.concatenate([[0], np.roll(filled, -offset).astype(int), [0]]))
+    starts = np.flatnonzero(edges == 1)
+    lengths = np.flatnonzero(edges == -1) - starts
+    starts = (starts + offset) % len(filled)
+    order = np.argsort(starts)
+
+    return starts[order], lengths[order]
+
+
+# ==================================================================================================
+# --- Functions to index and load filling schemes
+# ==================================================================================================
+def get_filling_scheme_hash(filling_scheme_path):
+    hash_object = hashlib.sha256()
+    with open(filling_scheme_path, "rb") as fid:
+        for chunk in iter(lambda: fid.read(2**20), b""):
+            hash_object.update(chunk)
+    return hash_object.hexdigest()
+
+
+def get_store_path(filling_scheme_path, hash_filling_scheme):
+    folder = os.path.join(os.path.dirname(os.path.abspath(filling_scheme_path)), STORE_FOLDER)
+    return os.path.join(folder, f"{hash_filling_scheme[:16]}.npz")
+
+
+def _compute_filling_scheme_entry(array_b1, array_b2):
+    # All the quantities stored for a filling scheme, as a dictionnary of arrays
+    d_entry = {
+        "version": np.array(STORE_VERSION),
+        "packed_beam1": np.packbits(array_b1 == 1),
+        "packed_beam2": np.packbits(array_b2 == 1),
+        "n_collisions": np.array(compute_n_collisions(array_b1, array_b2)),
+    }
+    for beam, array in [("beam_1", array_b1), ("beam_2", array_b2)]:
+        df_table = compute_collision_table(array_b1, array_b2, N_LR_STORE, beam=beam)
+        for column in df_table.columns:
+            d_entry[f"collision_table_{beam}/{column}"] = df_table[column].to_numpy()
+        d_entry[f"train_starts_{beam}"], d_entry[f"train_lengths_{beam}"] = get_bunch_trains(array)
+
+    return d_entry
+
+
+def _filling_scheme_from_entry(d_entry):
+    # Unpack a store entry into the dictionnary returned by load_filling_scheme
+    filling_scheme = {
+        "beam1": np.unpackbits(d_entry["packed_beam1"], count=N_SLOTS).astype(int),
+        "beam2": np.unpackbits(d_entry["packed_beam2"], count=N_SLOTS).astype(int),
+    }
+    (
+        filling_scheme["n_collisions_ip1_and_5"],
+        filling_scheme["n_collisions_ip2"],
+        filling_scheme["n_collisions_ip8"],
+    ) = [int(n) for n in d_entry["n_collisions"]]
+    for beam in ["beam_1", "beam_2"]:
+        prefix = f"collision_table_{beam}/"
+        filling_scheme[f"collision_table_{beam}"] = pd.DataFrame(
+            {key[len(prefix) :]: d_entry[key] for key in d_entry if key.startswith(prefix)}
+        )
+        filling_scheme[f"train_starts_{beam}"] = d_entry[f"train_starts_{beam}"]
+        filling_scheme[f"train_lengths_{beam}"] = d_entry[f"train_lengths_{beam}"]
+
+    return filling_scheme
+
+
+def index_filling_scheme(filling_scheme_path):
+    # Returns None if the filling scheme is not in the correct format (e.g. LPC format), in which
+    # case it must be converted first
+    with open(filling_scheme_path, "r") as fid:
+        d_filling_scheme = json.load(fid)
+    if "beam1" not in d_filling_scheme or "beam2" not in d_filling_scheme:
+        return None
+
+    array_b1 = np.array(d_filling_scheme["beam1"], dtype=int)
+    array_b2 = np.array(d_filling_scheme["beam2"], dtype=int)
+    d_entry = _compute_filling_scheme_entry(array_b1, array_b2)
+
+    # Write the entry atomically, the store being shared between jobs. If the store can't be written,
+    # the filling scheme is simply analysed again in the next process
+    path_entry = get_store_path(filling_scheme_path, get_filling_scheme_hash(filling_scheme_path))
+    try:
+        os.makedirs(os.path.dirname(path_entry), exist_ok=True)
+        with open(f"{path_entry}.tmp.{os.getpid()}", "wb") as fid:
+            np.savez_compressed(fid, **d_entry)
+        os.replace(f"{path_entry}.tmp.{os.getpid()}", path_entry)
+    except OSError as e:
+        print(f"Filling scheme store not writable, entry not saved: {e}")
+
+    return _filling_scheme_from_entry(d_entry)
+
+
+def load_filling_scheme(filling_scheme_path):
+    """
+    Returns a dictionnary with the arrays of both beams ("beam1" and "beam2"), the number of
+    collisions in each IP ("n_collisions_ip1_and_5", "n_collisions_ip2", "n_collisions_ip8"), and,
+    for each beam ("beam_1" or "beam_2"), the ranked collision table of the bunches (computed with
+    N_LR_STORE long-range collisions) and the bunch trains. The filling scheme is indexed if it's not
+    in the store yet. Returns None if the filling scheme is not in the correct format.
+    """
+    if not filling_scheme_path.endswith(".json"):
+        raise ValueError(f"Unknown filling scheme file format: {filling_scheme_path}.")
+
+    # Reuse the filling scheme if already loaded by this process
+    stat = os.stat(filling_scheme_path)
+    key = (os.path.abspath(filling_scheme_path), stat.st_mtime_ns, stat.st_size)
+    if key in _d_loaded_filling_schemes:
+        return _d_loaded_filling_schemes[key]
+
+    filling_scheme = None
+    path_entry = get_store_path(filling_scheme_path, get_filling_scheme_hash(filling_scheme_path))
+    if os.path.isfile(path_entry):
+        with np.load(path_entry) as npz:
+            d_entry = dict(npz)
+        if int(d_entry["version"]) == STORE_VERSION:
+            filling_scheme = _filling_scheme_from_entry(d_entry)
+    if filling_scheme is None:
+        filling_scheme = index_filling_scheme(filling_scheme_path)
+
+    _d_loaded_filling_schemes[key] = filling_scheme
+    return filling_scheme
+
+
+def index_folder(folder):
+    # Index all the filling schemes of a folder
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith(".json"):
+            continue
+        path = os.path.join(folder, filename)
+        if index_filling_scheme(path) is None:
+            print(f"Skipping {filename} (not converted yet)")
+        else:
+            print(f"Indexed {filename}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        l_folders = sys.argv[1:]
+    else:
+        l_folders = [
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "master_jobs/filling_scheme")
+        ]
+    for folder in l_folders:
+        index_folder(folder)
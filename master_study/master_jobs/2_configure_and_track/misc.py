@@ -1,8 +1,8 @@
 # Imports
 import json
 import logging
+from contextlib import contextmanager
 from scipy.constants import c as clight
-from scipy.optimize import minimize_scalar
 import xtrack as xt
 import numpy as np
 
@@ -368,58 +368,236 @@ def luminosity_leveling_ip1_5(
     config_collider,
     config_bb,
     crab=False,
+    twiss_cache=None,
 ):
     # Get Twiss
-    twiss_b1 = collider["lhcb1"].twiss()
-    twiss_b2 = collider["lhcb2"].twiss()
-
-    def compute_lumi(I):
-        luminosity = xt.lumi.luminosity_from_twiss(
-            n_colliding_bunches=config_collider["config_lumi_leveling_ip1_5"][
-                "num_colliding_bunches"
-            ],
-            num_particles_per_bunch=I,
-            ip_name="ip1",
-            nemitt_x=config_bb["nemitt_x"],
-            nemitt_y=config_bb["nemitt_y"],
-            sigma_z=config_bb["sigma_z"],
-            twiss_b1=twiss_b1,
-            twiss_b2=twiss_b2,
-            crab=crab,
-        )
-        return luminosity
+    twiss_b1 = get_twiss(collider, "lhcb1", twiss_cache)
+    twiss_b2 = get_twiss(collider, "lhcb2", twiss_cache)
+
+    config_leveling = config_collider["config_lumi_leveling_ip1_5"]
+    num_colliding_bunches = config_leveling["num_colliding_bunches"]
+
+    # For fixed optics, the luminosity is quadratic in the intensity, so the geometric factor only
+    # needs to be computed once (for any reference intensity)
+    I_ref = 1e11
+    luminosity_ref = xt.lumi.luminosity_from_twiss(
+        n_colliding_bunches=num_colliding_bunches,
+        num_particles_per_bunch=I_ref,
+        ip_name="ip1",
+        nemitt_x=config_bb["nemitt_x"],
+        nemitt_y=config_bb["nemitt_y"],
+        sigma_z=config_bb["sigma_z"],
+        twiss_b1=twiss_b1,
+        twiss_b2=twiss_b2,
+        crab=crab,
+    )
+    geometric_factor = luminosity_ref / I_ref**2
 
-    def f(I):
-        luminosity = compute_lumi(I)
+    # Maximum luminosity allowed by the pile-up
+    luminosity_max = config_leveling["constraints"]["max_PU"] / compute_PU(
+        1.0, num_colliding_bunches, twiss_b1["T_rev0"]
+    )
 
-        PU = compute_PU(luminosity, config_collider["config_lumi_leveling_ip1_5"]["num_colliding_bunches"], twiss_b1["T_rev0"])
-        penalty_PU = max(
-            0,
-            (PU - config_collider["config_lumi_leveling_ip1_5"]["constraints"]["max_PU"]) * 1e35,
+    # Get the leveled intensity
+    I = compute_leveled_intensity(
+        geometric_factor,
+        config_leveling["luminosity"],
+        luminosity_max=luminosity_max,
+        I_max=float(config_leveling["constraints"]["max_intensity"]),
+    )
+    if np.isclose(I, float(config_leveling["constraints"]["max_intensity"])):
+        logging.warning(
+            "Leveling in IP 1/5 limited by the maximum intensity. Please check the constraints."
         )
+    print(f"Leveling in IP 1/5 done with I={I:.2e} particles per bunch")
+    return float(I)
+
+
+def compute_leveled_intensity(
+    geometric_factor, luminosity_target, luminosity_max=np.inf, I_min=1e10, I_max=np.inf
+):
+    # Invert the luminosity L = geometric_factor * I^2, aiming at the target luminosity without
+    # exceeding the maximum luminosity (e.g. from the pile-up), for the intensity in [I_min, I_max].
+    # All parameters can be arrays (e.g. to get a leveling table for many target luminosities)
+    luminosity = np.minimum(luminosity_target, luminosity_max)
+    return np.clip(np.sqrt(luminosity / geometric_factor), I_min, I_max)
+
+
+# Delay of the collisions in the IPs, in number of slots (as used to install beam-beam)
+DELAY_AT_IPS_SLOTS = {"ip1": 0, "ip2": 891, "ip5": 0, "ip8": 2670}
 
+
+def get_collision_schedules(array_b1, array_b2, l_bunches, config_bb, beam="lhcb1"):
+    # For each bunch of the given beam, whether it meets a bunch of the other beam at each head-on
+    # and long-range encounter of each IP (one row per bunch)
+    l_bunches = np.asarray(l_bunches)
+    n_slots = len(array_b1)
+    slots_per_encounter = max(config_bb["bunch_spacing_buckets"] // 10, 1)
+    l_schedules = []
+    for ip, delay in DELAY_AT_IPS_SLOTS.items():
+        n_lr = config_bb["num_long_range_encounters_per_side"][ip]
+        offsets = np.arange(-n_lr, n_lr + 1) * slots_per_encounter
+        if beam == "lhcb1":
+            l_schedules.append(array_b2[(l_bunches[:, None] + delay + offsets) % n_slots])
+        else:
+            l_schedules.append(array_b1[(l_bunches[:, None] - delay + offsets) % n_slots])
+    return np.concatenate(l_schedules, axis=1)
+
+
+def get_bunches_with_unique_schedules(array_b1, array_b2, l_bunches, config_bb, beam="lhcb1"):
+    # Keep the first bunch of each distinct collision schedule, along with the number of bunches
+    # sharing this schedule
+    l_bunches = np.asarray(l_bunches)
+    schedules = get_collision_schedules(array_b1, array_b2, l_bunches, config_bb, beam)
+    _, idx_first, counts = np.unique(schedules, axis=0, return_index=True, return_counts=True)
+    order = np.argsort(idx_first)
+    return l_bunches[idx_first[order]].tolist(), counts[order].tolist()
+
+
+# Class to avoid recomputing the twiss of a line on an unchanged machine. Only the last twiss of each
+# line is kept, indexed by the values of the independent knobs of the collider. The knobs known not
+# to act on a line (e.g. the tuning knobs of the other beam) can be excluded from its index, such that
+# changing them doesn't invalidate its twiss. The cache only sees the knobs: invalidate() must be
+# called when the elements are modified directly (e.g. when configuring the beam-beam lenses)
+class TwissCache:
+    def __init__(self, collider, d_excluded_knobs=None):
+        self.collider = collider
+        self.d_excluded_knobs = {
+            line_name: set(l_knobs) for line_name, l_knobs in (d_excluded_knobs or {}).items()
+        }
+        self.d_twiss = {}
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def get_key(self, line_name, kwargs):
+        s_excluded = self.d_excluded_knobs.get(line_name, set())
         return (
-            abs(luminosity - config_collider["config_lumi_leveling_ip1_5"]["luminosity"])
-            + penalty_PU
+            tuple(sorted(kwargs.items())),
+            tuple(
+                (name, self.collider.varval[name])
+                for name in self.collider.vars.get_independent_vars()
+                if name not in s_excluded
+            ),
         )
 
-    # Do the optimization
-    res = minimize_scalar(
-        f,
-        bounds=(
-            1e10,
-            float(config_collider["config_lumi_leveling_ip1_5"]["constraints"]["max_intensity"]),
-        ),
-        method="bounded",
-        options={"xatol": 1e7},
-    )
-    if not res.success:
-        logging.warning("Optimization for leveling in IP 1/5 failed. Please check the constraints.")
-    else:
-        print(
-            f"Optimization for leveling in IP 1/5 succeeded with I={res.x:.2e} particles per bunch"
-        )
-    return res.x
+    def twiss(self, line_name, **kwargs):
+        key = self.get_key(line_name, kwargs)
+        try:
+            if line_name in self.d_twiss and self.d_twiss[line_name][0] == key:
+                self.n_hits += 1
+                return self.d_twiss[line_name][1]
+        except (TypeError, ValueError):
+            # Knobs that can't be compared (e.g. arrays), the twiss is not cached
+            self.n_misses += 1
+            return self.collider[line_name].twiss(**kwargs)
+
+        self.n_misses += 1
+        tw = self.collider[line_name].twiss(**kwargs)
+        self.d_twiss[line_name] = (key, tw)
+        return tw
+
+    def invalidate(self):
+        self.d_twiss = {}
+
+    def report(self):
+        print(f"Twiss cache: {self.n_hits} hits, {self.n_misses} misses")
+
+
+def get_twiss(collider, line_name, twiss_cache=None, **kwargs):
+    # Get the twiss of a line, from the cache if provided
+    if twiss_cache is not None:
+        return twiss_cache.twiss(line_name, **kwargs)
+    return collider[line_name].twiss(**kwargs)
+
+
+# Functions to get and set the values of the knobs that are not controlled by an expression, i.e. the
+# knobs defining the configuration of a collider on top of its lattice
+def get_knob_values(collider):
+    d_knobs = {}
+    for name in collider.vars.get_independent_vars():
+        value = collider.varval[name]
+        if isinstance(value, (int, float, np.number)):
+            d_knobs[name] = float(value)
+    return d_knobs
+
+
+def set_knob_values(collider, d_knobs):
+    # Only the knobs which have changed are set, to limit the updates of the dependencies
+    d_knobs_current = get_knob_values(collider)
+    for name, value in d_knobs.items():
+        if d_knobs_current.get(name, None) != value:
+            collider.vars[name] = value
+
+
+# Classes of the beam-beam lenses, whose strength is recorded along with the knobs
+BEAMBEAM_CLASSES = ["BeamBeamBiGaussian2D", "BeamBeamBiGaussian3D"]
+
+
+# Class to record the state of a collider (value or expression of the knobs and of the strength of
+# the beam-beam lenses), such that it can be restored later without copying the lattice. The other
+# properties of the lenses are set directly when configuring beam-beam, but they have no effect once
+# the strength of the lenses is restored (e.g. to 0 before beam-beam configuration). Knobs created
+# after the snapshot are left untouched
+class ColliderSnapshot:
+    def __init__(self, collider):
+        self.collider = collider
+        self.l_bb_elements = [
+            (line_name, name)
+            for line_name, line in collider.lines.items()
+            for name, element in zip(line.element_names, line.elements)
+            if element.__class__.__name__ in BEAMBEAM_CLASSES
+        ]
+        self.state = self.get_state()
+
+    def get_state(self):
+        d_vars = {}
+        for name in self.collider.vars.keys():
+            value = self.collider.varval[name]
+            expr = self.collider.vars[name]._expr
+            d_vars[name] = (str(expr), expr) if expr is not None else (None, value)
+        d_bb_elements = {}
+        for line_name, name in self.l_bb_elements:
+            expr = self.collider[line_name].element_refs[name].scale_strength._expr
+            value = self.collider[line_name][name].scale_strength
+            d_bb_elements[(line_name, name)] = (
+                (str(expr), expr) if expr is not None else (None, value)
+            )
+        return d_vars, d_bb_elements
+
+    def set_state(self, state):
+        # Only the knobs and lenses which have changed are set, to limit the updates of the
+        # dependencies
+        d_vars, d_bb_elements = state
+        d_vars_current, d_bb_elements_current = self.get_state()
+        for name, (str_expr_saved, saved) in d_vars.items():
+            str_expr, current = d_vars_current.get(name, (None, None))
+            if str_expr_saved != str_expr or (
+                str_expr_saved is None and not np.array_equal(saved, current)
+            ):
+                self.collider.vars[name] = saved
+        for (line_name, name), (str_expr_saved, saved) in d_bb_elements.items():
+            str_expr, current = d_bb_elements_current[(line_name, name)]
+            if str_expr_saved != str_expr or (str_expr_saved is None and saved != current):
+                self.collider[line_name].element_refs[name].scale_strength = saved
+
+        # Check that the lenses are back to their recorded strength
+        for (line_name, name), (str_expr_saved, saved) in d_bb_elements.items():
+            expected = saved._get_value() if str_expr_saved is not None else saved
+            if self.collider[line_name][name].scale_strength != expected:
+                raise ValueError(f"Strength of the beam-beam lens {name} could not be restored.")
+
+    def restore(self):
+        self.set_state(self.state)
+
+    @contextmanager
+    def restored(self):
+        # Restore the snapshot temporarily, and go back to the current state afterwards
+        state_current = self.get_state()
+        self.restore()
+        try:
+            yield self.collider
+        finally:
+            self.set_state(state_current)
 
 
 if __name__ == "__main__":
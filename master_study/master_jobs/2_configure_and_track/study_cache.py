@@ -0,0 +1,319 @@
+# Imports
+import copy
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+import numpy as np
+import ruamel.yaml
+import xobjects as xo
+import xtrack as xt
+import xfields as xf
+from collider_io import load_collider, save_collider
+
+# Initialize yaml reader
+ryaml = ruamel.yaml.YAML()
+
+# Time after which a lock is considered stale (e.g. the job holding it has been evicted) [s]. A held
+# lock is refreshed every LOCK_HEARTBEAT_PERIOD, such that it never becomes stale while its job is
+# alive, however long the job takes
+LOCK_TIMEOUT = 600
+LOCK_HEARTBEAT_PERIOD = 60
+
+# Time between two checks of a lock held by another job [s]
+LOCK_POLLING_PERIOD = 10
+
+# Typical scan steps of the tune and chromaticity, used to measure the distance between two
+# working points in the knob store
+KNOB_STORE_SCALES = {"qx": 1e-3, "qy": 1e-3, "dqx": 1.0, "dqy": 1.0}
+
+# Size of the buckets grouping the entries of the knob store, in typical scan steps
+KNOB_STORE_BUCKET_SIZE = 10
+
+
+# Function to hash a set of (json serializable) configurations along with the content of some files
+def get_hash(l_configs, l_files=[]):
+    hash_object = hashlib.sha256()
+    hash_object.update(json.dumps(l_configs, sort_keys=True, default=str).encode())
+    for path in l_files:
+        with open(path, "rb") as fid:
+            for chunk in iter(lambda: fid.read(2**20), b""):
+                hash_object.update(chunk)
+    return hash_object.hexdigest()
+
+
+# Events stopping the refresh of the locks held by this process, indexed by the path of the lock
+_d_lock_heartbeats = {}
+
+
+def refresh_lock(path_lock, stop_event):
+    # Update the modification time of the lock until it's released (or removed by another job)
+    while not stop_event.wait(LOCK_HEARTBEAT_PERIOD):
+        try:
+            os.utime(path_lock)
+        except FileNotFoundError:
+            return
+
+
+# Function to try to take a lock, returns True if the lock has been acquired. The lock is then
+# refreshed in a background thread until it's released
+def acquire_lock(path_lock):
+    # Remove the lock if it's stale
+    try:
+        if time.time() - os.path.getmtime(path_lock) > LOCK_TIMEOUT:
+            print(f"Removing stale lock {path_lock}")
+            os.remove(path_lock)
+    except FileNotFoundError:
+        pass
+
+    # Create the lock (fails if it already exists)
+    try:
+        fd = os.open(path_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        os.close(fd)
+    except FileExistsError:
+        return False
+
+    stop_event = threading.Event()
+    threading.Thread(target=refresh_lock, args=(path_lock, stop_event), daemon=True).start()
+    _d_lock_heartbeats[path_lock] = stop_event
+    return True
+
+
+def release_lock(path_lock):
+    stop_event = _d_lock_heartbeats.pop(path_lock, None)
+    if stop_event is not None:
+        stop_event.set()
+    try:
+        os.remove(path_lock)
+    except FileNotFoundError:
+        pass
+
+
+# Functions to store and retrieve configured colliders (in binary format), indexed by the hash of
+# their configuration
+def get_path_configured_collider(cache_folder, hash_config):
+    return f"{cache_folder}/{hash_config}"
+
+
+def get_path_lock_configured_collider(cache_folder, hash_config):
+    return f"{cache_folder}/{hash_config}.lock"
+
+
+def is_configured_collider_cached(cache_folder, hash_config):
+    return os.path.isfile(f"{get_path_configured_collider(cache_folder, hash_config)}/done")
+
+
+def load_configured_collider(cache_folder, hash_config):
+    path = get_path_configured_collider(cache_folder, hash_config)
+    collider = load_collider(f"{path}/collider.bin")
+    collider.build_trackers()
+    with open(f"{path}/config_collider.yaml", "r") as fid:
+        config_collider = ryaml.load(fid)
+    return collider, config_collider
+
+
+def store_configured_collider(cache_folder, hash_config, collider, config_collider):
+    # The entry is written in a temporary folder, moved into place once complete, such that two jobs
+    # storing the same entry (e.g. if the lock of a long configuration has been considered stale)
+    # never mix their files
+    path = get_path_configured_collider(cache_folder, hash_config)
+    path_tmp = f"{path}.tmp.{uuid.uuid4().hex}"
+    os.makedirs(path_tmp)
+    save_collider(collider, f"{path_tmp}/collider.bin")
+    with open(f"{path_tmp}/config_collider.yaml", "w") as fid:
+        ryaml.dump(config_collider, fid)
+
+    # Flag the entry as complete only once everything has been written
+    open(f"{path_tmp}/done", "w").close()
+    try:
+        os.replace(path_tmp, path)
+    except OSError:
+        # The entry has already been stored by another job
+        shutil.rmtree(path_tmp, ignore_errors=True)
+
+
+def wait_for_configured_collider(cache_folder, hash_config):
+    # Wait for another job to configure the collider, as long as it holds the lock. Returns True if
+    # the collider is available, and False if the lock could be acquired instead
+    path_lock = get_path_lock_configured_collider(cache_folder, hash_config)
+    while not is_configured_collider_cached(cache_folder, hash_config):
+        if acquire_lock(path_lock):
+            # Check again, in case the collider was stored in the meantime
+            if is_configured_collider_cached(cache_folder, hash_config):
+                release_lock(path_lock)
+                return True
+            return False
+        print(f"Collider being configured by another job, waiting {LOCK_POLLING_PERIOD} s...")
+        time.sleep(LOCK_POLLING_PERIOD)
+    return True
+
+
+# Functions to share compiled tracking kernels between jobs, indexed by the element classes of the
+# line, the tracker configuration and the xsuite versions. The kernels prebuilt with xtrack (e.g. with
+# xsuite-prebuild, see make_miniforge.sh) are used in priority. The cache is only needed for the
+# other kernels (e.g. of an optimized line), and relies on private attributes of the xtrack tracker:
+# it's only used with the xtrack versions below, the kernel being compiled in each job otherwise
+KERNEL_CACHE_XTRACK_VERSIONS = ["0.45"]
+
+
+def is_kernel_cache_supported():
+    return ".".join(xt.__version__.split(".")[:2]) in KERNEL_CACHE_XTRACK_VERSIONS
+
+
+def get_track_kernel_name(line):
+    tracker = line.tracker
+    l_classes = sorted(
+        cls._DressingClass.__name__ for cls in tracker._tracker_data_base.kernel_element_classes
+    )
+    versions = [xt.__version__, xo.__version__, xf.__version__]
+    return f"track_kernel_{get_hash([l_classes, tracker._hashable_config(), versions])[:16]}"
+
+
+def build_track_kernel(line):
+    # Compile the kernel for the present configuration of the tracker (public xtrack api), such that
+    # it's available before the tracking worker processes are forked
+    line.tracker.get_track_kernel_and_data_for_present_config()
+
+
+def load_or_build_track_kernel(line, cache_folder):
+    # Attach to the tracker the kernel from the cache if available, otherwise compile it into the
+    # cache. If the kernel is being compiled into the cache by another job, or if anything goes
+    # wrong, the kernel is compiled locally
+    tracker = line.tracker
+    if not is_kernel_cache_supported():
+        logging.warning(
+            f"Tracking kernel cache not supported with xtrack {xt.__version__}, the kernel is"
+            " compiled locally"
+        )
+        build_track_kernel(line)
+        return
+
+    # Use the prebuilt kernel of xtrack if there is one for this line
+    from xtrack.prebuild_kernels import get_suitable_kernel
+
+    if get_suitable_kernel(tracker.config, tracker.line_element_classes) is not None:
+        build_track_kernel(line)
+        return
+
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        kernel_name = get_track_kernel_name(line)
+        if os.path.isfile(f"{cache_folder}/{kernel_name}.json"):
+            print(f"Loading tracking kernel {kernel_name} from cache")
+            kernel_description = tracker.get_kernel_descriptions(
+                tracker._tracker_data_base.kernel_element_classes
+            )["track_line"]
+            kernels = tracker._context.kernels_from_file(
+                module_name=kernel_name,
+                containing_dir=cache_folder,
+                kernel_descriptions={"track_line": kernel_description},
+            )
+            kernel = kernels[("track_line", (tracker.particles_class._XoStruct,))]
+
+        # Only one job compiles a given kernel into the cache, the others compile it locally
+        elif acquire_lock(f"{cache_folder}/{kernel_name}.lock"):
+            try:
+                print(f"Compiling tracking kernel {kernel_name} into cache")
+                kernel = tracker._build_kernel(
+                    compile="force", module_name=kernel_name, containing_dir=cache_folder
+                )
+
+                # Flag the kernel as available once compiled (the flag is moved into place, such
+                # that it's never read incomplete)
+                path_flag = f"{cache_folder}/{kernel_name}.json"
+                with open(f"{path_flag}.tmp.{uuid.uuid4().hex}", "w") as fid:
+                    json.dump(dict(tracker._hashable_config()), fid, indent=4, default=str)
+                os.replace(fid.name, path_flag)
+            finally:
+                release_lock(f"{cache_folder}/{kernel_name}.lock")
+        else:
+            print(f"Tracking kernel {kernel_name} being compiled by another job, compiling locally")
+            build_track_kernel(line)
+            return
+
+        tracker.track_kernel[tracker._hashable_config()] = kernel
+
+    except Exception as e:
+        logging.warning(f"Tracking kernel cache not available, the kernel is compiled locally: {e}")
+        build_track_kernel(line)
+
+
+# Functions to store the knobs obtained by matching, and retrieve the ones of the nearest working
+# point as a starting point for the matchings. Working points are compared only if the rest of the
+# configuration is identical
+def get_knob_store_context_hash(config_collider, config_mad):
+    config_context = copy.deepcopy(config_collider)
+    for key in KNOB_STORE_SCALES:
+        config_context["config_knobs_and_tuning"].pop(key)
+    return get_hash([config_context, config_mad])
+
+
+def get_knob_store_point(config_collider):
+    conf_knobs_and_tuning = config_collider["config_knobs_and_tuning"]
+    return [
+        float(conf_knobs_and_tuning[key][line_name]) / scale
+        for line_name in ["lhcb1", "lhcb2"]
+        for key, scale in KNOB_STORE_SCALES.items()
+    ]
+
+
+def get_knob_store_bucket(point):
+    # Entries are grouped in buckets of KNOB_STORE_BUCKET_SIZE scan steps along each dimension, such
+    # that only the buckets near a working point are read
+    return tuple(int(np.floor(x / KNOB_STORE_BUCKET_SIZE)) for x in point)
+
+
+def get_knob_store_bucket_distance(point, bucket):
+    # Lower bound of the distance between a working point and the entries of a bucket
+    lower = np.array(bucket) * KNOB_STORE_BUCKET_SIZE
+    gap = np.maximum(np.maximum(lower - point, np.array(point) - lower - KNOB_STORE_BUCKET_SIZE), 0)
+    return np.linalg.norm(gap)
+
+
+def store_knobs(store_folder, hash_context, point, d_knobs):
+    # A working point is only stored once (its particle chunks have the same knobs), and the entry is
+    # moved into place once complete
+    path = f"{store_folder}/{hash_context}/{'_'.join(map(str, get_knob_store_bucket(point)))}"
+    path_knobs = f"{path}/{get_hash([point])[:16]}.json"
+    if os.path.isfile(path_knobs):
+        return
+    os.makedirs(path, exist_ok=True)
+    with open(f"{path_knobs}.tmp.{uuid.uuid4().hex}", "w") as fid:
+        json.dump({"point": point, "knobs": d_knobs}, fid, indent=4)
+    os.replace(fid.name, path_knobs)
+
+
+def load_nearest_knobs(store_folder, hash_context, point):
+    # Returns None if no working point has been stored yet for this context. The buckets are read by
+    # increasing distance, until the remaining ones can't contain a nearer working point
+    path = f"{store_folder}/{hash_context}"
+    if not os.path.isdir(path):
+        return None
+
+    l_buckets = []
+    for bucket_name in os.listdir(path):
+        if not os.path.isdir(f"{path}/{bucket_name}"):
+            continue
+        bucket = tuple(int(x) for x in bucket_name.split("_"))
+        l_buckets.append((get_knob_store_bucket_distance(point, bucket), bucket_name))
+
+    d_knobs_nearest = None
+    distance_nearest = np.inf
+    for distance_bucket, bucket_name in sorted(l_buckets):
+        if distance_bucket >= distance_nearest:
+            break
+        for filename in os.listdir(f"{path}/{bucket_name}"):
+            if not filename.endswith(".json"):
+                continue
+            with open(f"{path}/{bucket_name}/{filename}", "r") as fid:
+                entry = json.load(fid)
+            distance = np.linalg.norm(np.array(entry["point"]) - np.array(point))
+            if distance < distance_nearest:
+                d_knobs_nearest = entry["knobs"]
+                distance_nearest = distance
+
+    return d_knobs_nearest
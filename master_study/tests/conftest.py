@@ -0,0 +1,30 @@
+import json
+import os
+import sys
+import numpy as np
+import pytest
+
+# The modules of the study and of the jobs are not packaged: make them importable by the tests
+FOLDER_STUDY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in [os.path.join(FOLDER_STUDY, "master_jobs", "2_configure_and_track"), FOLDER_STUDY]:
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+# Filling scheme used by the tests
+FILLING_SCHEME_PATH = os.path.join(
+    FOLDER_STUDY,
+    "master_jobs",
+    "filling_scheme",
+    "25ns_2374b_2361_1730_1773_236bpi_13inj_hybrid_2INDIV_converted.json",
+)
+
+
+@pytest.fixture(params=["lpc", "random"])
+def filling_scheme_arrays(request):
+    # Arrays of both beams of a real filling scheme, and of a random one
+    if request.param == "lpc":
+        with open(FILLING_SCHEME_PATH, "r") as fid:
+            d_filling_scheme = json.load(fid)
+        return np.array(d_filling_scheme["beam1"]), np.array(d_filling_scheme["beam2"])
+    rng = np.random.default_rng(0)
+    return (rng.random(3564) < 0.3).astype(int), (rng.random(3564) < 0.3).astype(int)
@@ -0,0 +1,74 @@
+import json
+import numpy as np
+import pytest
+
+xt = pytest.importorskip("xtrack")
+xo = pytest.importorskip("xobjects")
+from collider_io import get_collider_extension, load_collider, save_collider
+
+
+def make_line(beam, n_cells=4):
+    # Small thin FODO ring whose quadrupoles are driven by knobs
+    elements = {}
+    for ii in range(n_cells):
+        elements[f"qf.{ii}.{beam}"] = xt.Multipole(knl=[0, 0.0])
+        elements[f"d1.{ii}.{beam}"] = xt.Drift(length=5.0)
+        elements[f"qd.{ii}.{beam}"] = xt.Multipole(knl=[0, 0.0], ksl=[1e-6, 0])
+        elements[f"d2.{ii}.{beam}"] = xt.Drift(length=5.0)
+    line = xt.Line(elements=elements, element_names=list(elements))
+    line.particle_ref = xt.Particles(p0c=7e12, q0=1, mass0=xt.PROTON_MASS_EV)
+    line._init_var_management()
+    line.vars["kq_common"] = 0.2
+    line.vars[f"kqf.{beam}"] = 0.01
+    for ii in range(n_cells):
+        line.element_refs[f"qf.{ii}.{beam}"].knl[1] = (
+            line.vars["kq_common"] + line.vars[f"kqf.{beam}"]
+        )
+        line.element_refs[f"qd.{ii}.{beam}"].knl[1] = -line.vars["kq_common"]
+    return line
+
+
+@pytest.fixture
+def collider():
+    return xt.Multiline(lines={"lhcb1": make_line("b1"), "lhcb2": make_line("b2")})
+
+
+def dumps(collider):
+    return json.dumps(collider.to_dict(), cls=xo.JEncoder, sort_keys=True)
+
+
+@pytest.mark.parametrize("collider_format", ["binary", "json"])
+def test_round_trip(tmp_path, collider, collider_format):
+    path = str(tmp_path / f"collider.{get_collider_extension(collider_format)}")
+    save_collider(collider, path)
+    collider_loaded = load_collider(path)
+    assert dumps(collider_loaded) == dumps(collider)
+
+    # The knobs still drive the elements
+    collider_loaded.vars["kq_common"] = 0.3
+    assert np.isclose(collider_loaded["lhcb1"]["qf.0.b1"].knl[1], 0.31)
+    assert np.isclose(collider_loaded["lhcb2"]["qd.3.b2"].knl[1], -0.3)
+
+
+def test_binary_file_is_not_modified(tmp_path, collider):
+    # The arrays are memory-mapped in copy-on-write mode when loading
+    path = str(tmp_path / "collider.bin")
+    save_collider(collider, path)
+    with open(path, "rb") as fid:
+        content = fid.read()
+    collider_loaded = load_collider(path)
+    collider_loaded.vars["kq_common"] = 0.3
+    with open(path, "rb") as fid:
+        assert fid.read() == content
+
+
+def test_invalid_binary_file(tmp_path, collider):
+    path = str(tmp_path / "collider.bin")
+    collider.to_json(path)
+    with pytest.raises(ValueError):
+        load_collider(path)
+
+
+def test_unknown_format():
+    with pytest.raises(ValueError):
+        get_collider_extension("pickle")
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("xtrack")
+from filling_scheme_store import compute_collision_table
+from misc import DELAY_AT_IPS_SLOTS, get_bunches_with_unique_schedules, get_collision_schedules
+
+CONFIG_BB = {
+    "bunch_spacing_buckets": 10,
+    "num_long_range_encounters_per_side": {"ip1": 25, "ip2": 20, "ip5": 25, "ip8": 20},
+}
+
+
+def get_collision_schedule_loop(array_b1, array_b2, bunch, beam):
+    # Reference: encounters of a single bunch, one at a time
+    l_schedule = []
+    for ip, delay in DELAY_AT_IPS_SLOTS.items():
+        n_lr = CONFIG_BB["num_long_range_encounters_per_side"][ip]
+        for encounter in range(-n_lr, n_lr + 1):
+            if beam == "lhcb1":
+                l_schedule.append(array_b2[(bunch + delay + encounter) % len(array_b2)])
+            else:
+                l_schedule.append(array_b1[(bunch - delay + encounter) % len(array_b1)])
+    return l_schedule
+
+
+@pytest.mark.parametrize("beam", ["lhcb1", "lhcb2"])
+def test_collision_schedules_match_loop(filling_scheme_arrays, beam):
+    array_b1, array_b2 = filling_scheme_arrays
+    l_bunches = np.flatnonzero(array_b1 if beam == "lhcb1" else array_b2)
+    schedules = get_collision_schedules(array_b1, array_b2, l_bunches, CONFIG_BB, beam)
+    for bunch, schedule in zip(l_bunches, schedules):
+        assert schedule.tolist() == get_collision_schedule_loop(array_b1, array_b2, bunch, beam)
+
+
+@pytest.mark.parametrize("beam", ["lhcb1", "lhcb2"])
+def test_collision_schedules_match_collision_table(filling_scheme_arrays, beam):
+    # The head-on and long-range collisions of the schedules are the ones of the collision table
+    array_b1, array_b2 = filling_scheme_arrays
+    l_bunches = np.flatnonzero(array_b1 if beam == "lhcb1" else array_b2)
+    schedules = get_collision_schedules(array_b1, array_b2, l_bunches, CONFIG_BB, beam)
+    df_table = compute_collision_table(
+        array_b1, array_b2, [20, 25, 20], beam="beam_1" if beam == "lhcb1" else "beam_2"
+    )
+    df_table = df_table.set_index("bunch").loc[l_bunches]
+
+    start = 0
+    for ip, n_lr in CONFIG_BB["num_long_range_encounters_per_side"].items():
+        schedules_ip = schedules[:, start : start + 2 * n_lr + 1]
+        start += 2 * n_lr + 1
+        name = "ip1_5" if ip in ["ip1", "ip5"] else ip
+        assert np.array_equal(schedules_ip[:, n_lr] == 1, df_table[f"HO {name}"])
+        assert np.array_equal(
+            schedules_ip.sum(axis=1) - schedules_ip[:, n_lr], df_table[f"LR {name}"]
+        )
+
+
+def test_bunches_with_unique_schedules(filling_scheme_arrays):
+    array_b1, array_b2 = filling_scheme_arrays
+    l_bunches = np.flatnonzero(array_b1)
+    l_unique, l_counts = get_bunches_with_unique_schedules(array_b1, array_b2, l_bunches, CONFIG_BB)
+
+    # Each bunch is represented by the first bunch with the same schedule
+    d_schedules = {}
+    for bunch in l_bunches:
+        schedule = tuple(get_collision_schedule_loop(array_b1, array_b2, bunch, "lhcb1"))
+        d_schedules.setdefault(schedule, []).append(bunch)
+    assert l_unique == [l_bunches_schedule[0] for l_bunches_schedule in d_schedules.values()]
+    assert l_counts == [len(l_bunches_schedule) for l_bunches_schedule in d_schedules.values()]
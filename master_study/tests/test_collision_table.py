@@ -0,0 +1,69 @@
+import json
+import shutil
+import numpy as np
+import pytest
+from conftest import FILLING_SCHEME_PATH
+from filling_scheme_store import compute_collision_table
+from user_defined_functions import get_worst_bunch
+
+# Delays of the head-on collisions in ALICE, ATLAS/CMS and LHCb, in slots
+L_COLLIDE_FACTORS = [891, 0, 2670]
+
+
+def compute_LR_per_bunch_loop(array_b1, array_b2, numberOfLRToConsider, beam):
+    # Reference: collisions of each bunch counted one slot at a time, a bunch missing a head-on
+    # collision having no long-range collision
+    if beam == "beam_2":
+        array_b1, array_b2 = array_b2, array_b1
+    factor = 1 if beam == "beam_1" else -1
+    n_slots = len(array_b1)
+    l_long_range_per_bunch = []
+    for n in np.flatnonzero(array_b1):
+        num_of_long_range = 0
+        all_HO = True
+        for collide_factor, n_LR in zip(L_COLLIDE_FACTORS, numberOfLRToConsider):
+            m = (n + factor * collide_factor) % n_slots
+            all_HO &= bool(array_b2[m])
+            for k in range(-n_LR, n_LR + 1):
+                if k != 0:
+                    num_of_long_range += array_b2[(m + k) % n_slots]
+        l_long_range_per_bunch.append(num_of_long_range if all_HO else 0)
+    return l_long_range_per_bunch
+
+
+@pytest.mark.parametrize("beam", ["beam_1", "beam_2"])
+@pytest.mark.parametrize("numberOfLRToConsider", [[26, 26, 26], [20, 25, 20]])
+def test_collision_table_matches_loop(filling_scheme_arrays, beam, numberOfLRToConsider):
+    array_b1, array_b2 = filling_scheme_arrays
+    bunches = np.flatnonzero(array_b1 if beam == "beam_1" else array_b2)
+    l_long_range_per_bunch = compute_LR_per_bunch_loop(
+        array_b1, array_b2, numberOfLRToConsider, beam
+    )
+
+    df_table = compute_collision_table(array_b1, array_b2, numberOfLRToConsider, beam=beam)
+    assert sorted(df_table["bunch"]) == bunches.tolist()
+    df_table_by_bunch = df_table.set_index("bunch").loc[bunches]
+    assert df_table_by_bunch["LR for ranking"].tolist() == l_long_range_per_bunch
+
+    # The first bunch of the ranking is the first bunch with the most long-range collisions
+    assert df_table["bunch"].iloc[0] == bunches[np.argmax(l_long_range_per_bunch)]
+    assert df_table["rank"].tolist() == list(range(len(bunches)))
+
+
+@pytest.mark.parametrize("beam", ["beam_1", "beam_2"])
+@pytest.mark.parametrize("numberOfLRToConsider", [26, 20])
+def test_worst_bunch(tmp_path, beam, numberOfLRToConsider):
+    # The filling scheme is copied, such that its store is written in a temporary folder
+    filling_scheme_path = str(tmp_path / "filling_scheme.json")
+    shutil.copy(FILLING_SCHEME_PATH, filling_scheme_path)
+    with open(filling_scheme_path, "r") as fid:
+        d_filling_scheme = json.load(fid)
+    array_b1 = np.array(d_filling_scheme["beam1"])
+    array_b2 = np.array(d_filling_scheme["beam2"])
+
+    bunches = np.flatnonzero(array_b1 if beam == "beam_1" else array_b2)
+    l_long_range_per_bunch = compute_LR_per_bunch_loop(
+        array_b1, array_b2, [numberOfLRToConsider] * 3, beam
+    )
+    worst_bunch = get_worst_bunch(filling_scheme_path, numberOfLRToConsider, beam=beam)
+    assert worst_bunch == bunches[np.argmax(l_long_range_per_bunch)]
@@ -0,0 +1,86 @@
+import copy
+from user_defined_functions import materialize_child_configuration, update_configuration
+
+CONFIG_CHILDREN = {
+    "config_simulation": {"n_turns": 200, "beam": "lhcb1", "cheap_dimensions": None},
+    "config_collider": {
+        "config_knobs_and_tuning": {
+            "qx": {"lhcb1": 62.316, "lhcb2": 62.316},
+            "qy": {"lhcb1": 60.321, "lhcb2": 60.321},
+            "knob_settings": {"on_x1": 250, "i_oct_b1": 60.0},
+        },
+        "config_beambeam": {"num_particles_per_bunch": 1.4e11},
+    },
+    "dump_collider": False,
+}
+
+
+def test_update_configuration_is_recursive():
+    config = copy.deepcopy(CONFIG_CHILDREN)
+    update = {"config_collider": {"config_knobs_and_tuning": {"qx": {"lhcb1": 62.31}}}}
+    update_configuration(config, update)
+
+    # Only the updated leaf changes, the other keys of the nested dictionnaries are kept
+    expected = copy.deepcopy(CONFIG_CHILDREN)
+    expected["config_collider"]["config_knobs_and_tuning"]["qx"]["lhcb1"] = 62.31
+    assert config == expected
+
+
+def test_update_configuration_replaces_non_dictionnaries():
+    config = {"a": {"b": 1}, "c": [1, 2], "d": None}
+    update_configuration(config, {"a": 2, "c": [3], "d": {"e": 1}, "f": {"g": 1}})
+    assert config == {"a": 2, "c": [3], "d": {"e": 1}, "f": {"g": 1}}
+
+
+def test_update_configuration_copies_the_update():
+    config = {}
+    update = {"a": {"b": [1, 2]}}
+    update_configuration(config, update)
+    config["a"]["b"].append(3)
+    assert update == {"a": {"b": [1, 2]}}
+
+
+def test_materialize_child_configuration():
+    config_parent = {"config_children": copy.deepcopy(CONFIG_CHILDREN)}
+    config_child = {
+        "log_file": "tree_maker.log",
+        "config_overrides": {
+            "config_simulation": {"beam": "lhcb2"},
+            "config_collider": {
+                "config_knobs_and_tuning": {
+                    "qx": {"lhcb1": 62.31, "lhcb2": 62.31},
+                    "knob_settings": {"i_oct_b1": -300.0},
+                }
+            },
+        },
+    }
+
+    # Reference: full configuration of the child, as previously written in each child
+    expected = copy.deepcopy(CONFIG_CHILDREN)
+    expected["log_file"] = "tree_maker.log"
+    expected["config_simulation"]["beam"] = "lhcb2"
+    expected["config_collider"]["config_knobs_and_tuning"]["qx"] = {"lhcb1": 62.31, "lhcb2": 62.31}
+    expected["config_collider"]["config_knobs_and_tuning"]["knob_settings"]["i_oct_b1"] = -300.0
+
+    config_child_copy = copy.deepcopy(config_child)
+    assert materialize_child_configuration(config_child, config_parent) == expected
+
+    # Neither the child nor the default configuration are modified
+    assert config_child == config_child_copy
+    assert config_parent == {"config_children": CONFIG_CHILDREN}
+
+
+def test_materialize_full_child_configuration():
+    # Children written with their full configuration (e.g. older studies) are kept as they are
+    config_child = copy.deepcopy(CONFIG_CHILDREN)
+    config_parent = {"config_children": {"config_simulation": {"n_turns": 1}}}
+    assert materialize_child_configuration(config_child, config_parent) == CONFIG_CHILDREN
+    assert materialize_child_configuration(config_child, {}) == CONFIG_CHILDREN
+
+
+def test_materialize_child_configuration_without_defaults():
+    config_child = {"config_overrides": {"config_simulation": {"beam": "lhcb2"}}}
+    for config_parent in [{}, {"config_children": None}]:
+        assert materialize_child_configuration(config_child, config_parent) == {
+            "config_simulation": {"beam": "lhcb2"}
+        }
@@ -0,0 +1,111 @@
+import copy
+import os
+import ruamel.yaml
+import yaml
+from conftest import FOLDER_STUDY
+from configuration import materialize_child_configuration
+from user_defined_functions import (
+    _write_node_folder,
+    get_scan_overrides,
+    iter_scan_grid,
+    update_configuration,
+    write_children_configurations,
+)
+
+JOB_FOLDER = os.path.join(FOLDER_STUDY, "master_jobs", "1_build_distr_and_collider")
+JOB_FOLDER_TRACK = os.path.join(FOLDER_STUDY, "master_jobs", "2_configure_and_track")
+
+
+class Node:
+    # Minimal node of a tree, with the attributes used to write its folder
+    def __init__(self, path, parameters, root=None):
+        self.path = path
+        self.parameters = parameters
+        self.root = self if root is None else root
+
+    def get_abs_path(self):
+        return self.path
+
+
+def test_write_node_folder(tmp_path):
+    parameters = {
+        "config_particles": {"r_max": 12, "n_split": 4},
+        "config_mad": {"optics_file": "acc-models-lhc/strengths/optics.madx"},
+        "children": {"xtrack_0000": {}},
+    }
+    root_parameters = {
+        "generations": {
+            1: {
+                "job_folder": JOB_FOLDER,
+                "job_executable": "1_build_distr_and_collider.py",
+                "files_to_clone": ["optics_specific_tools.py", "collider_io.py"],
+            }
+        }
+    }
+    root = Node(str(tmp_path), root_parameters)
+    node = Node(str(tmp_path / "base_collider"), copy.deepcopy(parameters), root)
+    with open(f"{JOB_FOLDER}/config.yaml", "r") as fid:
+        config_template = ruamel.yaml.YAML().load(fid)
+    _write_node_folder(node, 1, config_template, lambda node, generation_number: "echo\n")
+
+    # The parameters of the node are merged recursively into the template configuration
+    with open(f"{JOB_FOLDER}/config.yaml", "r") as fid:
+        template = fid.read()
+    with open(f"{node.get_abs_path()}/config.yaml", "r") as fid:
+        written = fid.read()
+    parameters.pop("children")
+    assert yaml.safe_load(written) == update_configuration(yaml.safe_load(template), parameters)
+
+    # The comments of the template are kept, and the template itself is unchanged
+    assert written.count("#") == template.count("#")
+    assert config_template["config_particles"]["r_max"] != 12
+
+    # The job files are cloned (the content of the linked modules is copied)
+    for filename in ["1_build_distr_and_collider.py", "optics_specific_tools.py", "collider_io.py"]:
+        path = f"{node.get_abs_path()}/{filename}"
+        assert os.path.isfile(path) and not os.path.islink(path)
+    assert os.access(f"{node.get_abs_path()}/run.sh", os.X_OK)
+
+
+def test_write_children_configurations(tmp_path):
+    d_dimensions = {
+        "qx": {
+            "paths": ["config_collider.config_knobs_and_tuning.qx.lhcb1"],
+            "values": [62.31, 62.32],
+        },
+        "qy": {
+            "paths": ["config_collider.config_knobs_and_tuning.qy.lhcb1"],
+            "values": [60.32, 60.33],
+        },
+    }
+    l_names = write_children_configurations(
+        str(tmp_path), JOB_FOLDER_TRACK, d_dimensions, iter_scan_grid(d_dimensions, batch_size=3)
+    )
+    assert l_names == ["xtrack_0000", "xtrack_0001", "xtrack_0002", "xtrack_0003"]
+
+    # Each child holds the template along with its overrides, which give the same configuration as
+    # the parameters of the child previously stored in the tree
+    with open(f"{JOB_FOLDER_TRACK}/config.yaml", "r") as fid:
+        template = yaml.safe_load(fid)
+    d_grid = next(iter_scan_grid(d_dimensions))
+    for idx, name in enumerate(l_names):
+        with open(f"{tmp_path}/{name}/config.yaml", "r") as fid:
+            written = yaml.safe_load(fid)
+        parameters = {"config_overrides": get_scan_overrides(d_dimensions, d_grid, idx)}
+        expected = update_configuration(copy.deepcopy(template), parameters)
+        assert materialize_child_configuration(written, {}) == materialize_child_configuration(
+            expected, {}
+        )
+
+    # Existing children are left untouched when appending new ones
+    with open(f"{tmp_path}/xtrack_0000/config.yaml", "w") as fid:
+        fid.write("kept")
+    write_children_configurations(
+        str(tmp_path),
+        JOB_FOLDER_TRACK,
+        d_dimensions,
+        iter_scan_grid(d_dimensions),
+        skip_existing=True,
+    )
+    with open(f"{tmp_path}/xtrack_0000/config.yaml", "r") as fid:
+        assert fid.read() == "kept"
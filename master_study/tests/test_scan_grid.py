@@ -0,0 +1,115 @@
+import itertools
+import os
+import numpy as np
+import pytest
+import yaml
+from conftest import FOLDER_STUDY
+from user_defined_functions import (
+    build_scan_grid,
+    evaluate_scan_constraints,
+    get_scan_overrides,
+    iter_scan_grid,
+)
+
+N_SPLIT = 4
+
+
+def get_study_scan():
+    # Scan of the example study, with the particle chunks added as the first dimension (as done in
+    # 001_make_folders.py)
+    with open(os.path.join(FOLDER_STUDY, "config.yaml"), "r") as fid:
+        d_scan = yaml.safe_load(fid)["scan"]
+    d_dimensions = {
+        "track": {
+            "paths": ["config_simulation.particle_file"],
+            "values": list(range(N_SPLIT)),
+            "format": "../particles/{:02}.parquet",
+        },
+        **d_scan["dimensions"],
+    }
+    return d_dimensions, d_scan["constraints"]
+
+
+def get_scan_loop(keep="upper_triangle"):
+    # Reference: scan previously built in 001_make_folders.py, one working point at a time
+    array_qx = np.round(np.arange(62.305, 62.330, 0.001), decimals=4)[:5]
+    array_qy = np.round(np.arange(60.305, 60.330, 0.001), decimals=4)[:5]
+    l_points = []
+    for track, qx, qy in itertools.product(np.arange(N_SPLIT), array_qx, array_qy):
+        if keep == "upper_triangle" and qy < (qx - 2 - 0.0039):
+            continue
+        elif keep == "lower_triangle" and qy >= (qx - 2 - 0.0039):
+            continue
+        l_points.append((track, qx, qy))
+    return l_points
+
+
+def test_scan_grid_matches_loop():
+    d_dimensions, l_constraints = get_study_scan()
+    d_grid = build_scan_grid(d_dimensions, l_constraints)
+    l_points = list(zip(d_grid["track"], d_grid["qx"], d_grid["qy"]))
+    assert l_points == get_scan_loop()
+
+    # Overrides of the children, as previously written in full for each child
+    for idx_point, (track, qx, qy) in enumerate(l_points):
+        assert get_scan_overrides(d_dimensions, d_grid, idx_point) == {
+            "config_simulation": {"particle_file": f"../particles/{track:02}.parquet"},
+            "config_collider": {
+                "config_knobs_and_tuning": {
+                    "qx": {"lhcb1": qx, "lhcb2": qx},
+                    "qy": {"lhcb1": qy, "lhcb2": qy},
+                }
+            },
+        }
+
+
+def test_scan_grid_batches():
+    # The points are the same whatever the size of the batches
+    d_dimensions, l_constraints = get_study_scan()
+    d_grid = build_scan_grid(d_dimensions, l_constraints)
+    l_batches = list(iter_scan_grid(d_dimensions, l_constraints, batch_size=7))
+    assert len(l_batches) == -(-N_SPLIT * 5 * 5 // 7)
+    for name in d_dimensions:
+        assert np.concatenate([d_batch[name] for d_batch in l_batches]).tolist() == (
+            d_grid[name].tolist()
+        )
+
+
+def test_scan_grid_other_constraints():
+    d_dimensions, _ = get_study_scan()
+    d_grid = build_scan_grid(d_dimensions, ["qy < qx - 2 - 0.0039"])
+    assert list(zip(d_grid["track"], d_grid["qx"], d_grid["qy"])) == get_scan_loop("lower_triangle")
+    d_grid = build_scan_grid(d_dimensions)
+    assert len(d_grid["qx"]) == N_SPLIT * 5 * 5
+
+
+def test_scan_grid_zip():
+    d_dimensions = {
+        "qx": {"paths": ["qx"], "values": [62.31, 62.32, 62.33], "zip": "tunes"},
+        "i_oct": {"paths": ["i_oct"], "values": {"arange": [0, 200, 100]}},
+        "qy": {"paths": ["qy"], "values": [60.32, 60.33, 60.34], "zip": "tunes"},
+    }
+    d_grid = build_scan_grid(d_dimensions, ["np.abs(i_oct) > 50"])
+    assert list(zip(d_grid["qx"], d_grid["qy"], d_grid["i_oct"])) == [
+        (62.31, 60.32, 100),
+        (62.32, 60.33, 100),
+        (62.33, 60.34, 100),
+    ]
+
+    d_dimensions["qy"]["values"] = [60.32, 60.33]
+    with pytest.raises(ValueError):
+        build_scan_grid(d_dimensions)
+
+
+def test_evaluate_scan_constraints():
+    d_grid = {"qx": np.array([62.31, 62.32, 62.33]), "qy": np.array([60.31, 60.33, 60.32])}
+    assert evaluate_scan_constraints(d_grid, [], 3).tolist() == [True, True, True]
+    assert evaluate_scan_constraints(d_grid, ["qy >= qx - 2"], 3).tolist() == [True, True, False]
+    assert evaluate_scan_constraints(d_grid, ["qy >= qx - 2", "qx > 62.31"], 3).tolist() == [
+        False,
+        True,
+        False,
+    ]
+
+    # Constraints independent of the grid are broadcasted to all the points
+    assert evaluate_scan_constraints(d_grid, ["False"], 3).tolist() == [False, False, False]
@@ -0,0 +1,95 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+
+pytest.importorskip("xtrack")
+pytest.importorskip("xfields")
+from study_cache import (
+    LOCK_TIMEOUT,
+    acquire_lock,
+    load_nearest_knobs,
+    release_lock,
+    store_knobs,
+)
+
+
+def test_lock_is_exclusive(tmp_path):
+    path_lock = str(tmp_path / "collider.lock")
+    assert acquire_lock(path_lock)
+    assert not acquire_lock(path_lock)
+
+    # Once released, the lock can be taken again
+    release_lock(path_lock)
+    assert not os.path.exists(path_lock)
+    assert acquire_lock(path_lock)
+
+
+def test_release_missing_lock(tmp_path):
+    # Releasing a lock that doesn't exist (e.g. removed as stale) is not an error
+    release_lock(str(tmp_path / "collider.lock"))
+
+
+def test_stale_lock_is_removed(tmp_path):
+    path_lock = str(tmp_path / "collider.lock")
+    assert acquire_lock(path_lock)
+
+    # A lock older than LOCK_TIMEOUT is considered abandoned by its job
+    mtime = time.time() - LOCK_TIMEOUT - 60
+    os.utime(path_lock, (mtime, mtime))
+    assert acquire_lock(path_lock)
+    assert not acquire_lock(path_lock)
+
+
+def test_lock_acquired_by_a_single_job(tmp_path):
+    path_lock = str(tmp_path / "collider.lock")
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        l_acquired = list(executor.map(lambda _: acquire_lock(path_lock), range(64)))
+    assert sum(l_acquired) == 1
+
+
+def test_held_lock_is_refreshed(tmp_path, monkeypatch):
+    import study_cache
+
+    monkeypatch.setattr(study_cache, "LOCK_HEARTBEAT_PERIOD", 0.05)
+    path_lock = str(tmp_path / "collider.lock")
+    assert acquire_lock(path_lock)
+
+    # A lock held longer than LOCK_TIMEOUT is not stale, since its job refreshes it
+    mtime = time.time() - LOCK_TIMEOUT - 60
+    os.utime(path_lock, (mtime, mtime))
+    time.sleep(0.5)
+    assert time.time() - os.path.getmtime(path_lock) < LOCK_TIMEOUT
+    assert not acquire_lock(path_lock)
+
+    # Once released, the lock is not refreshed anymore
+    release_lock(path_lock)
+    assert not os.path.exists(path_lock)
+
+
+def test_nearest_knobs(tmp_path):
+    # The nearest working point is found, although only the buckets near the point are read
+    rng = np.random.default_rng(0)
+    l_points = [rng.uniform(-50, 50, size=8).tolist() for _ in range(200)]
+    for idx, point in enumerate(l_points):
+        store_knobs(str(tmp_path), "context", point, {"knob": idx})
+
+    for _ in range(20):
+        point = rng.uniform(-60, 60, size=8).tolist()
+        distances = np.linalg.norm(np.array(l_points) - np.array(point), axis=1)
+        d_knobs = load_nearest_knobs(str(tmp_path), "context", point)
+        assert d_knobs == {"knob": int(np.argmin(distances))}
+
+    # Nothing is stored for another context
+    assert load_nearest_knobs(str(tmp_path), "other_context", l_points[0]) is None
+
+
+def test_knobs_stored_once(tmp_path):
+    # The particle chunks of a working point don't store it again
+    point = [62.31e3, 60.32e3, 5.0, 5.0, 62.31e3, 60.32e3, 5.0, 5.0]
+    store_knobs(str(tmp_path), "context", point, {"knob": 1})
+    store_knobs(str(tmp_path), "context", point, {"knob": 2})
+    assert load_nearest_knobs(str(tmp_path), "context", point) == {"knob": 1}
+    l_files = [filename for _, _, l_filenames in os.walk(tmp_path) for filename in l_filenames]
+    assert len(l_files) == 1
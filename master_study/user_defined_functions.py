@@ -1,7 +1,19 @@
 import numpy as np
+import copy
 import json
+import ruamel.yaml
 import yaml
 import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from configuration import materialize_child_configuration, update_configuration
+from filling_scheme_store import (
+    N_LR_STORE,
+    compute_collision_table,
+    index_filling_scheme,
+    load_filling_scheme,
+)
 
 
 def generate_run_sh(node, generation_number):
@@ -26,9 +38,16 @@ def generate_run_sh_htc(node, generation_number):
         abs_path = node.get_abs_path()
         local_path = abs_path.split("/")[-1]
 
-        # Mutate all paths in config to be absolute
-        with open(f"{abs_path}/config.yaml", "r") as f:
-            config = yaml.load(f, Loader=yaml.FullLoader)
+        # Mutate all paths in config to be absolute (the paths shared by all the children are in the
+        # configuration of gen 1). The configuration is taken from the tree, not from the files,
+        # unless the tree only holds the log file of the node (see write_children_configurations)
+        if "config_overrides" in node.parameters:
+            config = materialize_child_configuration(node.parameters, node.parent.parameters)
+        else:
+            with open(f"{abs_path}/config.yaml", "r") as fid:
+                config = materialize_child_configuration(
+                    yaml.safe_load(fid), node.parent.parameters
+                )
 
         # Get paths to mutate
         path_collider = config["config_simulation"]["collider_file"]
@@ -46,6 +65,24 @@ def generate_run_sh_htc(node, generation_number):
         new_path_particles = new_path_particles.replace("/", "\/")
         new_path_log = new_path_log.replace("/", "\/")
 
+        # The checkpoint folder and the caches (if any) must remain in the node folder to survive
+        # an eviction and be shared between jobs (absolute paths are left untouched)
+        str_sed_optional_paths = ""
+        for key in [
+            "checkpoint_folder",
+            "configured_collider_cache",
+            "kernel_cache",
+            "knob_store",
+            "tune_chroma_response_file",
+        ]:
+            path = config["config_simulation"].get(key, None)
+            if path is not None and not os.path.isabs(path):
+                new_path = f"{abs_path}/{path}".replace("/", "\/")
+                path = path.replace("/", "\/")
+                str_sed_optional_paths += (
+                    f'sed -i "s/{key}: {path}/{key}: {new_path}/g" config.yaml ../config.yaml\n'
+                )
+
         # Return final run script
         return (
             f"#!/bin/bash\n"
@@ -57,9 +94,10 @@ def generate_run_sh_htc(node, generation_number):
             f"cp -f {abs_path}/config.yaml {local_path}\n"
             f"cd {local_path}\n"
             # Mutate the paths in config to be absolute
-            f'sed -i "s/{path_collider}/{new_path_collider}/g" config.yaml\n'
-            f'sed -i "s/{path_particles}/{new_path_particles}/g" config.yaml\n'
+            f'sed -i "s/{path_collider}/{new_path_collider}/g" config.yaml ../config.yaml\n'
+            f'sed -i "s/{path_particles}/{new_path_particles}/g" config.yaml ../config.yaml\n'
             f'sed -i "s/{path_log}/{new_path_log}/g" config.yaml\n'
+            f"{str_sed_optional_paths}"
             # Run the job
             f"python {node.get_abs_path()}/{python_command} > output_python.txt 2>"
             " error_python.txt\n"
@@ -77,109 +115,269 @@ def generate_run_sh_htc(node, generation_number):
         return generate_run_sh(node, generation_number)
 
 
-def _compute_LR_per_bunch(
-    _array_b1, _array_b2, _B1_bunches_index, _B2_bunches_index, numberOfLRToConsider, beam="beam_1"
-):
-    # Reverse beam order if needed
-    if beam == "beam_1":
-        factor = 1
-    elif beam == "beam_2":
-        _array_b1, _array_b2 = _array_b2, _array_b1
-        _B1_bunches_index, _B2_bunches_index = _B2_bunches_index, _B1_bunches_index
-        factor = -1
+def get_scan_values(d_dimension):
+    # Get the array of values of a scan dimension, given as a list or as a numpy range
+    values = d_dimension["values"]
+    if not isinstance(values, dict):
+        return np.array(values)
+    if "linspace" in values:
+        array_values = np.linspace(*values["linspace"])
+    elif "arange" in values:
+        array_values = np.arange(*values["arange"])
     else:
-        raise ValueError("beam must be either 'beam_1' or 'beam_2'")
-
-    B2_bunches = np.array(_array_b2) == 1.0
-
-    # Define number of LR to consider
-    if isinstance(numberOfLRToConsider, int):
-        numberOfLRToConsider = [numberOfLRToConsider, numberOfLRToConsider, numberOfLRToConsider]
-
-    l_long_range_per_bunch = []
-    for n in _B1_bunches_index:
-        # First check for collisions in ALICE
-
-        # Formula for head on collision in ALICE is
-        # (n + 891) mod 3564 = m
-        # where n is number of bunch in B1, and m is number of bunch in B2
+        raise ValueError(f"Unknown definition of the scan values: {values}.")
 
-        # Formula for head on collision in ATLAS/CMS is
-        # n = m
-        # where n is number of bunch in B1, and m is number of bunch in B2
+    # Round if needed, to correct for numpy numerical instabilities
+    if "decimals" in values:
+        array_values = np.round(array_values, decimals=values["decimals"])
+    return array_values
 
-        # Formula for head on collision in LHCb is
-        # (n + 2670) mod 3564 = m
-        # where n is number of bunch in B1, and m is number of bunch in B2
 
-        colide_factor_list = [891, 0, 2670]
-        number_of_bunches = 3564
-
-        # i == 0 for ALICE
-        # i == 1 for ATLAS and CMS
-        # i == 2 for LHCB
-        num_of_long_range = 0
-        l_HO = [False, False, False]
-        for i in range(0, 3):
-            collide_factor = colide_factor_list[i]
-            m = (n + factor * collide_factor) % number_of_bunches
-
-            # if this bunch is true, then there is head on collision
-            l_HO[i] = B2_bunches[m]
-
-            ## Check if beam 2 has bunches in range  m - numberOfLRToConsider to m + numberOfLRToConsider
-            ## Also have to check if bunches wrap around from 3563 to 0 or vice versa
-
-            bunches_ineraction_temp = np.array([])
-            positions = np.array([])
-
-            first_to_consider = m - numberOfLRToConsider[i]
-            last_to_consider = m + numberOfLRToConsider[i] + 1
-
-            numb_of_long_range = 0
-
-            if first_to_consider < 0:
-                bunches_ineraction_partial = np.flatnonzero(
-                    _array_b2[(number_of_bunches + first_to_consider) : (number_of_bunches)]
+def iter_scan_grid(d_dimensions, l_constraints=[], batch_size=2**16):
+    """
+    Iterates over the points of the grid satisfying the constraints by batches of (at most)
+    batch_size points of the grid, yielding the values of each dimension (as arrays) for the points
+    of a batch. Dimensions sharing the same zip group are zipped, and the others combined as a
+    product (the first dimension varying the slowest). Constraints are numpy expressions of the
+    dimension names, evaluated on each batch at once. Only one batch is in memory at a time.
+    """
+    d_values = {name: get_scan_values(d_dimension) for name, d_dimension in d_dimensions.items()}
+
+    # Group the zipped dimensions, and check that they have the same length
+    d_groups = {}
+    for name, d_dimension in d_dimensions.items():
+        group = ("zip", d_dimension["zip"]) if "zip" in d_dimension else name
+        d_groups.setdefault(group, []).append(name)
+    for l_names in d_groups.values():
+        if len({len(d_values[name]) for name in l_names}) > 1:
+            raise ValueError(f"Zipped dimensions {l_names} must have the same length.")
+
+    # Build the grid batch by batch, as one flat array per dimension, from the flat indices of the
+    # points of the batch
+    shape = [len(d_values[l_names[0]]) for l_names in d_groups.values()]
+    n_points = int(np.prod(shape))
+    n_points_kept = 0
+    for start in range(0, n_points, batch_size):
+        n_points_batch = min(batch_size, n_points - start)
+        array_indices = np.unravel_index(np.arange(start, start + n_points_batch), shape)
+        d_batch = {}
+        for indices, l_names in zip(array_indices, d_groups.values()):
+            for name in l_names:
+                d_batch[name] = d_values[name][indices]
+
+        # Evaluate the constraints on the whole batch
+        mask = evaluate_scan_constraints(d_batch, l_constraints, n_points_batch)
+        n_points_kept += int(np.sum(mask))
+        yield {name: array[mask] for name, array in d_batch.items()}
+
+    print(f"Scan of {n_points} points, {n_points_kept} remaining after applying the constraints.")
+
+
+def build_scan_grid(d_dimensions, l_constraints=[]):
+    """
+    Returns the values of each dimension of the scan (as arrays) for all the points of the grid
+    satisfying the constraints (see iter_scan_grid). The whole scan is in memory: prefer
+    iter_scan_grid for large scans.
+    """
+    l_batches = list(iter_scan_grid(d_dimensions, l_constraints))
+    return {name: np.concatenate([d_batch[name] for d_batch in l_batches]) for name in d_dimensions}
+
+
+def evaluate_scan_constraints(d_grid, l_constraints, n_points):
+    # Returns the mask of the points of the grid satisfying all the constraints
+    mask = np.ones(n_points, dtype=bool)
+    for constraint in l_constraints:
+        mask &= np.broadcast_to(eval(constraint, {"np": np}, dict(d_grid)), (n_points,))
+    return mask
+
+
+def get_scan_overrides(d_dimensions, d_grid, idx_point):
+    # Get the configuration overrides corresponding to a point of the scan
+    d_overrides = {}
+    for name, d_dimension in d_dimensions.items():
+        value = d_grid[name][idx_point]
+
+        # Need to explicitly convert to python types for yaml serialization
+        if isinstance(value, np.generic):
+            value = value.item()
+        if "format" in d_dimension:
+            value = d_dimension["format"].format(value)
+
+        for path in d_dimension["paths"]:
+            *l_keys, last_key = path.split(".")
+            d_overrides_path = d_overrides
+            for key in l_keys:
+                d_overrides_path = d_overrides_path.setdefault(key, {})
+            d_overrides_path[last_key] = value
+    return d_overrides
+
+
+def get_refined_points_path(study_name):
+    return f"scans/{study_name}/refined_points.yaml"
+
+
+def load_refined_points(study_name):
+    # Working points added by all the stages of the refinement of the scan (empty if none)
+    path = get_refined_points_path(study_name)
+    if not os.path.isfile(path):
+        return []
+    with open(path, "r") as fid:
+        l_stages = yaml.safe_load(fid)["stages"]
+    return [point for l_points in l_stages for point in l_points]
+
+
+def store_refined_points(study_name, l_points):
+    # Add a stage of working points to the refinement of the scan
+    path = get_refined_points_path(study_name)
+    l_stages = []
+    if os.path.isfile(path):
+        with open(path, "r") as fid:
+            l_stages = yaml.safe_load(fid)["stages"]
+    l_stages.append(l_points)
+    with open(path, "w") as fid:
+        yaml.safe_dump({"stages": l_stages}, fid)
+    return len(l_stages)
+
+
+def write_children_configurations(
+    folder_parent,
+    job_folder,
+    d_dimensions,
+    iter_batches,
+    name_format="xtrack_{:04}",
+    n_threads=32,
+    skip_existing=False,
+):
+    """
+    Writes the configuration of the children of a node (in folder_parent) while iterating over the
+    batches of the scan grid (see iter_scan_grid), such that the scan is never entirely in memory.
+    The configuration of a child is the template of the job folder, along with the parameters
+    overriding the default configuration of the children. Returns the names of the children, which
+    are added to the tree with their log file only: their folders are then completed by
+    make_folders_parallel, which keeps these configurations. If skip_existing is True, the children
+    whose folder already exists (e.g. when appending nodes to an existing tree) are left untouched.
+    """
+    # The template is written as is (with its comments), followed by the overrides of the child
+    with open(f"{job_folder}/config.yaml", "r") as fid:
+        str_template = fid.read().rstrip("\n") + "\n"
+
+    def write_child(name, d_overrides):
+        path = f"{folder_parent}/{name}"
+        if skip_existing and os.path.isdir(path):
+            return
+        os.makedirs(path, exist_ok=True)
+        with open(f"{path}/config.yaml", "w") as fid:
+            fid.write(str_template)
+            yaml.safe_dump({"config_overrides": d_overrides}, fid, sort_keys=False)
+
+    l_names = []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for d_batch in iter_batches:
+            n_points_batch = len(next(iter(d_batch.values())))
+            l_names_batch = [
+                name_format.format(idx)
+                for idx in range(len(l_names), len(l_names) + n_points_batch)
+            ]
+            list(
+                executor.map(
+                    lambda idx: write_child(
+                        l_names_batch[idx], get_scan_overrides(d_dimensions, d_batch, idx)
+                    ),
+                    range(n_points_batch),
                 )
+            )
+            l_names += l_names_batch
+    return l_names
+
+
+def _write_node_folder(node, generation_number, config_template, generate_run):
+    # Clone the job files, and write the configuration and the run script of a node. The
+    # configuration is kept if the tree only holds the log file of the node, in which case it has
+    # been written by write_children_configurations
+    config_generation = node.root.parameters["generations"][generation_number]
+    job_folder = config_generation["job_folder"]
+    abs_path = node.get_abs_path()
+    l_files = [config_generation["job_executable"]] + config_generation.get("files_to_clone", [])
+    os.makedirs(abs_path, exist_ok=True)
+    for filename in l_files:
+        shutil.copy(f"{job_folder}/{filename}", abs_path)
+
+    # The parameters of the node are merged recursively into the template configuration (as done by
+    # tree_maker), which is dumped in round-trip mode to keep its comments and layout
+    if set(node.parameters) != {"log_file"}:
+        config = update_configuration(
+            copy.deepcopy(config_template),
+            {key: value for key, value in node.parameters.items() if key != "children"},
+        )
+        with open(f"{abs_path}/config.yaml", "w") as fid:
+            ruamel.yaml.YAML().dump(config, fid)
 
-                # This represents the relative position to the head-on bunch
-                positions = np.append(positions, first_to_consider + bunches_ineraction_partial)
+    with open(f"{abs_path}/run.sh", "w") as fid:
+        fid.write(generate_run(node, generation_number))
+    os.chmod(f"{abs_path}/run.sh", 0o755)
 
-                # Set this varibale so later the normal syntax wihtout the wrap around checking can be used
-                first_to_consider = 0
 
-            if last_to_consider > number_of_bunches:
-                bunches_ineraction_partial = np.flatnonzero(
-                    _array_b2[0 : last_to_consider - number_of_bunches]
+def make_folders_parallel(root, generate_run, n_threads=32, skip_existing=False):
+    """
+    Alternative to root.make_folders(generate_run), writing the folders of the nodes of a same
+    generation concurrently, as the layout of the tree is dominated by the latency of the filesystem
+    (e.g. AFS or EOS) rather than by the amount of data written. The generations are written one
+    after the other, such that parents always exist before their children. If skip_existing is True,
+    the nodes already written (e.g. when appending nodes to an existing tree), i.e. whose run script
+    exists, are left untouched.
+    """
+    for generation_number in sorted(root.parameters["generations"]):
+        start_time = time.time()
+
+        # The template configuration is parsed only once per generation
+        job_folder = root.parameters["generations"][generation_number]["job_folder"]
+        with open(f"{job_folder}/config.yaml", "r") as fid:
+            config_template = ruamel.yaml.YAML().load(fid)
+
+        l_nodes = list(root.generation(generation_number))
+        if skip_existing:
+            l_nodes = [
+                node for node in l_nodes if not os.path.isfile(f"{node.get_abs_path()}/run.sh")
+            ]
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            list(
+                executor.map(
+                    lambda node: _write_node_folder(
+                        node, generation_number, config_template, generate_run
+                    ),
+                    l_nodes,
                 )
+            )
+        print(f"The folders of generation {generation_number} ({len(l_nodes)} nodes) are ready.")
+        print("--- %s seconds ---" % (time.time() - start_time))
 
-                # This represents the relative position to the head-on bunch
-                positions = np.append(positions, number_of_bunches - m + bunches_ineraction_partial)
-
-                last_to_consider = number_of_bunches
 
-            bunches_ineraction_partial = np.append(
-                bunches_ineraction_temp,
-                np.flatnonzero(_array_b2[first_to_consider:last_to_consider]),
-            )
+def _compute_LR_per_bunch(
+    _array_b1, _array_b2, _B1_bunches_index, _B2_bunches_index, numberOfLRToConsider, beam="beam_1"
+):
+    # Get the number of long range collisions from the table of all bunches
+    df_table = compute_collision_table(_array_b1, _array_b2, numberOfLRToConsider, beam=beam)
+    bunches_index = _B1_bunches_index if beam == "beam_1" else _B2_bunches_index
+    return df_table.set_index("bunch").loc[bunches_index, "LR for ranking"].tolist()
 
-            # This represents the relative position to the head-on bunch
-            positions = np.append(positions, bunches_ineraction_partial - (m - first_to_consider))
 
-            # Substract head on collision from number of secondary collisions
-            num_of_long_range_curren_ip = len(positions) - _array_b2[m]
+def get_worst_bunches(filling_scheme_path, k=1, numberOfLRToConsider=26, beam="beam_1"):
+    # Returns the k bunches with the largest number of long range collisions (see get_worst_bunch)
 
-            # Add to total number of long range collisions
-            num_of_long_range += num_of_long_range_curren_ip
+    # Load the filling scheme from the store
+    filling_scheme = load_filling_scheme(filling_scheme_path)
 
-        # If a head-on collision is missing, discard the bunch by setting LR to 0
-        if False in l_HO:
-            num_of_long_range = 0
+    # Rank all the bunches according to their number of long range collisions (already done in the
+    # store for the default number of long range collisions)
+    if numberOfLRToConsider == N_LR_STORE:
+        df_table = filling_scheme[f"collision_table_{beam}"]
+    else:
+        df_table = compute_collision_table(
+            filling_scheme["beam1"], filling_scheme["beam2"], numberOfLRToConsider, beam=beam
+        )
 
-        # Add to list of long range collisions per bunch
-        l_long_range_per_bunch.append(num_of_long_range)
-    return l_long_range_per_bunch
+    # Need to explicitly convert to int for json serialization
+    return [int(bunch) for bunch in df_table["bunch"].iloc[:k]]
 
 
 def get_worst_bunch(filling_scheme_path, numberOfLRToConsider=26, beam="beam_1"):
@@ -189,33 +387,33 @@ def get_worst_bunch(filling_scheme_path, numberOfLRToConsider=26, beam="beam_1")
     the two beams, this function returns the worst bunch for each beam, according to their collision
     schedule.
     """
+    return get_worst_bunches(filling_scheme_path, 1, numberOfLRToConsider, beam=beam)[0]
 
-    # Load the filling scheme directly if json
-    if filling_scheme_path.endswith(".json"):
-        with open(filling_scheme_path, "r") as fid:
-            filling_scheme = json.load(fid)
-
-    # Extract booleans beam arrays
-    array_b1 = np.array(filling_scheme["beam1"])
-    array_b2 = np.array(filling_scheme["beam2"])
-
-    # Get bunches index
-    B1_bunches_index = np.flatnonzero(array_b1)
-    B2_bunches_index = np.flatnonzero(array_b2)
 
-    # Compute the number of long range collisions per bunch
-    l_long_range_per_bunch = _compute_LR_per_bunch(
-        array_b1, array_b2, B1_bunches_index, B2_bunches_index, numberOfLRToConsider, beam=beam
-    )
-
-    # Get the worst bunch for both beams
-    if beam == "beam_1":
-        worst_bunch = B1_bunches_index[np.argmax(l_long_range_per_bunch)]
-    elif beam == "beam_2":
-        worst_bunch = B2_bunches_index[np.argmax(l_long_range_per_bunch)]
-
-    # Need to explicitly convert to int for json serialization
-    return int(worst_bunch)
+def select_bunches(
+    filling_scheme_path, policy="worst", i_bunch=None, k=1, numberOfLRToConsider=26, beam="beam_1"
+):
+    """
+    Returns the list of bunches selected for a given beam, according to the selection policy:
+    "worst" (the worst bunch), "explicit" (the bunch i_bunch), "top_k" (the k worst bunches), or
+    "all_unique_schedules" (the worst bunch, the other bunches being scanned within the jobs). If no
+    filling scheme is provided, all bunch elements are considered and the bunch number is None.
+    """
+    if filling_scheme_path is None:
+        return [None]
+
+    if policy == "explicit":
+        if i_bunch is None:
+            raise ValueError(f"A bunch number must be provided for {beam} (explicit policy).")
+        if load_filling_scheme(filling_scheme_path)[beam.replace("_", "")][i_bunch] != 1:
+            raise ValueError(f"Bunch {i_bunch} of {beam} is not in the filling scheme.")
+        return [int(i_bunch)]
+    elif policy in ["worst", "all_unique_schedules"]:
+        return get_worst_bunches(filling_scheme_path, 1, numberOfLRToConsider, beam=beam)
+    elif policy == "top_k":
+        return get_worst_bunches(filling_scheme_path, k, numberOfLRToConsider, beam=beam)
+    else:
+        raise ValueError(f"Unknown bunch selection policy: {policy}.")
 
 
 def reformat_filling_scheme_from_lpc(filling_scheme_path, fill_number=None):
@@ -378,54 +576,97 @@ def reformat_filling_scheme_from_lpc(filling_scheme_path, fill_number=None):
     return B1, B2
 
 
-def reformat_filling_scheme_from_lpc_alt(filling_scheme_path):
+def _get_slots_from_lpc_csv(csv):
+    # Get the slots of the bunches of each beam from the csv of a LPC fill, in which they are listed
+    # in two tables (one per beam, starting with a header containing 'Slot', and ending with an
+    # empty line). Each table is located and parsed in a single pass
+    l_slots = []
+    start = csv.find("Slot")
+    while start != -1 and len(l_slots) < 2:
+        start = csv.find("\n", start)
+        if start == -1:
+            break
+        start += 1
+        end = csv.find("\n\n", start)
+        end = len(csv) if end == -1 else end
+        l_lines = csv[start:end].split("\n") if end > start else []
+        l_slots.append(np.array([line.split(",", 2)[1] for line in l_lines], dtype=int))
+        start = csv.find("Slot", end)
+
+    # Beams without any table are empty
+    l_slots += [np.zeros(0, dtype=int)] * (2 - len(l_slots))
+    return l_slots
+
+
+def get_converted_filling_scheme_path(filling_scheme_path, fill_number=None):
+    # The first fill of a file keeps the historical name, the others are suffixed by their number
+    if fill_number is None:
+        return filling_scheme_path.split(".json")[0] + "_converted.json"
+    return filling_scheme_path.split(".json")[0] + f"_fill_{fill_number}_converted.json"
+
+
+def convert_filling_scheme_from_lpc(filling_scheme_path, l_fill_numbers=None, index=False):
     """
-    Alternative to the function above, as sometimes the injection information is not present in the
-    file. Not optimized but works.
+    This function converts a .json file downloaded from the url link of LPC to the appropriate
+    format for xmask, using the bunch slots listed in the long-range tables of each fill. The fills
+    to convert can be provided as a list of fill numbers, or as "all" for all the fills of the file.
+    If not provided, only the first fill is converted. The converted filling schemes can also be
+    indexed in the filling scheme store. Returns a dictionnary of the (B1, B2) arrays per fill.
     """
 
-    # Load the filling scheme directly if json
+    # Load the filling scheme
     with open(filling_scheme_path, "r") as fid:
-        data = json.load(fid)
+        d_fills = json.load(fid)["fills"]
+    first_fill_number = list(d_fills.keys())[0]
+    if l_fill_numbers is None:
+        l_fill_numbers = [first_fill_number]
+    elif l_fill_numbers == "all":
+        l_fill_numbers = list(d_fills.keys())
+
+    d_arrays = {}
+    for fill_number in l_fill_numbers:
+        # Fill the beam arrays in one go from the slots of the bunches
+        slots_b1, slots_b2 = _get_slots_from_lpc_csv(d_fills[f"{fill_number}"]["csv"])
+        B1 = np.zeros(3564)
+        B2 = np.zeros(3564)
+        B1[slots_b1] = 1
+        B2[slots_b2] = 1
+        d_arrays[fill_number] = (B1, B2)
+
+        # Save the converted filling scheme
+        path_converted = get_converted_filling_scheme_path(
+            filling_scheme_path, None if f"{fill_number}" == first_fill_number else fill_number
+        )
+        data_json = {"beam1": B1.astype(int).tolist(), "beam2": B2.astype(int).tolist()}
+        with open(path_converted, "w") as file_bool:
+            json.dump(data_json, file_bool)
+        if index:
+            index_filling_scheme(path_converted)
 
-    # Take the first fill number
-    fill_number = list(data["fills"].keys())[0]
+    return d_arrays
 
-    # Do the conversion (Matteo's code)
-    string = ""
-    B1 = np.zeros(3564)
-    B2 = np.zeros(3564)
-    l_lines = data["fills"][f"{fill_number}"]["csv"].split("\n")
-    for idx, line in enumerate(l_lines):
-        # First time one encounters a line with 'Slot' in it, start indexing
-        if "Slot" in line:
-            # B1 is initially empty
-            if np.sum(B1) == 0:
-                for idx_2, line_2 in enumerate(l_lines[idx + 1 :]):
-                    l_line = line_2.split(",")
-                    if len(l_line) > 1:
-                        slot = l_line[1]
-                        B1[int(slot)] = 1
-                    else:
-                        break
-
-            # Same with B2
-            elif np.sum(B2) == 0:
-                for idx_2, line_2 in enumerate(l_lines[idx + 1 :]):
-                    l_line = line_2.split(",")
-                    if len(l_line) > 1:
-                        slot = l_line[1]
-                        B2[int(slot)] = 1
-                    else:
-                        break
-            else:
-                break
 
-    data_json = {"beam1": [int(ii) for ii in B1], "beam2": [int(ii) for ii in B2]}
+def convert_filling_schemes_from_lpc_in_folder(folder, l_fill_numbers="all", index=True):
+    # Convert all the LPC filling schemes of a folder (the ones already in the correct format are
+    # skipped)
+    for filename in sorted(os.listdir(folder)):
+        if not filename.endswith(".json") or filename.endswith("_converted.json"):
+            continue
+        path = os.path.join(folder, filename)
+        with open(path, "r") as fid:
+            if "fills" not in json.load(fid):
+                continue
+        d_arrays = convert_filling_scheme_from_lpc(path, l_fill_numbers=l_fill_numbers, index=index)
+        print(f"Converted {len(d_arrays)} fill(s) from {filename}")
 
-    with open(filling_scheme_path.split(".json")[0] + "_converted.json", "w") as file_bool:
-        json.dump(data_json, file_bool)
-    return B1, B2
+
+def reformat_filling_scheme_from_lpc_alt(filling_scheme_path):
+    """
+    Alternative to the function above, as sometimes the injection information is not present in the
+    file. Converts the first fill of the file.
+    """
+    d_arrays = convert_filling_scheme_from_lpc(filling_scheme_path)
+    return list(d_arrays.values())[0]
 
 
 if __name__ == "__main__":